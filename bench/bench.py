@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+
+import contextlib
+import glob
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+STUB_DIR = os.path.join(BENCH_DIR, "stub")
+BKMGR = os.path.join(REPO_DIR, "bkmgr.py")
+
+BACKENDS = ("direct", "btrfs", "lvm")
+BORGS = ("stub", "real")
+# Tools each backend needs besides losetup
+_TOOLS = {
+    "direct": ("mkfs.ext4",),
+    "btrfs": ("mkfs.btrfs", "btrfs"),
+    "lvm": ("mkfs.ext4", "pvcreate", "vgcreate", "lvcreate", "vgremove"),
+}
+# Room in the volume group for the snapshot, bkmgr is run with --cow-size 1
+_COW_MIB = 1024 + 128
+
+
+def _run(args: list) -> str:
+    logging.debug(f"Running {' '.join(args)}")
+    res = subprocess.run(args, capture_output=True, text=True)
+    if res.returncode != 0:
+        raise ChildProcessError(f"{' '.join(args)} failed: {res.stderr.strip()}")
+    return res.stdout
+
+
+# A sparse file of `sizeMiB` in `workDir` attached to a loop device, yields
+# the device path
+@contextlib.contextmanager
+def loopDevice(workDir: str, sizeMiB: int):
+    imagePath = os.path.join(workDir, f"loop{uuid.uuid4().hex}.img")
+    with open(imagePath, "wb") as f:
+        f.truncate(sizeMiB * 1024 * 1024)
+    try:
+        device = _run(["losetup", "--find", "--show", imagePath]).strip()
+        try:
+            yield device
+        finally:
+            _run(["losetup", "--detach", device])
+    finally:
+        os.unlink(imagePath)
+
+
+@contextlib.contextmanager
+def mounted(device: str, mountpoint: str, options: str = None):
+    os.makedirs(mountpoint, exist_ok=True)
+    _run(["mount"] + (["-o", options] if options else []) + [device, mountpoint])
+    try:
+        yield mountpoint
+    finally:
+        _run(["umount", mountpoint])
+        os.rmdir(mountpoint)
+
+
+# Builds a throwaway filesystem of `sizeMiB` for `backend`, yields the SRC
+# to back up and the directory to fill with data:
+#   direct: ext4 on a loop device, SRC is its mountpoint
+#   btrfs:  BTRFS on a loop device, SRC is a subvolume of it
+#   lvm:    ext4 on a logical volume of a volume group on a loop device,
+#           SRC is the logical volume, its filesystem stays mounted
+@contextlib.contextmanager
+def filesystem(backend: str, workDir: str, sizeMiB: int):
+    mountpoint = os.path.join(workDir, f"mnt-{backend}")
+    with contextlib.ExitStack() as stack:
+        if backend == "lvm":
+            device = stack.enter_context(loopDevice(workDir, sizeMiB + _COW_MIB))
+            volumeGroup = f"bkmgrbench{uuid.uuid4().hex[:8]}"
+            _run(["pvcreate", "-y", device])
+            stack.callback(_run, ["pvremove", "-y", device])
+            _run(["vgcreate", volumeGroup, device])
+            stack.callback(_run, ["vgremove", "-f", volumeGroup])
+            _run(["lvcreate", "-y", "-n", "data", "-L", f"{sizeMiB}M", volumeGroup])
+            volume = os.path.join(os.path.sep, "dev", volumeGroup, "data")
+            _run(["mkfs.ext4", "-q", volume])
+            stack.enter_context(mounted(volume, mountpoint))
+            yield volume, mountpoint
+        elif backend == "btrfs":
+            device = stack.enter_context(loopDevice(workDir, sizeMiB))
+            _run(["mkfs.btrfs", "-q", device])
+            stack.enter_context(mounted(device, mountpoint))
+            source = os.path.join(mountpoint, "data")
+            _run(["btrfs", "subvolume", "create", source])
+            yield source, source
+        else:
+            device = stack.enter_context(loopDevice(workDir, sizeMiB))
+            _run(["mkfs.ext4", "-q", device])
+            stack.enter_context(mounted(device, mountpoint))
+            yield mountpoint, mountpoint
+
+
+# Writes about `totalBytes` of synthetic data in `files` files below `path`,
+# 100 files per directory. Sizes vary around the mean, half of the files are
+# random and half compress well, the same `seed` gives the same tree.
+def fill(path: str, files: int, totalBytes: int, seed: int = 0):
+    rng = random.Random(seed)
+    mean = totalBytes // max(files, 1)
+    for i in range(files):
+        directory = os.path.join(path, f"d{i // 10000:03}", f"d{i // 100 % 100:02}")
+        os.makedirs(directory, exist_ok=True)
+        size = int(rng.expovariate(1 / mean)) if mean else 0
+        with open(os.path.join(directory, f"f{i:07}"), "wb") as f:
+            if i % 2:
+                f.write(rng.randbytes(size))
+            else:
+                f.write((f"{i} {rng.random()}\n" * (size // 20 + 1)).encode()[:size])
+
+
+# Rewrites `share` of the files below `path` between runs
+def churn(path: str, share: float, seed: int):
+    rng = random.Random(seed)
+    for dirPath, dirNames, fileNames in os.walk(path):
+        dirNames.sort()
+        for fileName in sorted(fileNames):
+            if rng.random() < share:
+                filePath = os.path.join(dirPath, fileName)
+                size = os.lstat(filePath).st_size
+                with open(filePath, "wb") as f:
+                    f.write(rng.randbytes(size))
+
+
+def dropCaches():
+    os.sync()
+    with open("/proc/sys/vm/drop_caches", "w") as f:
+        f.write("3\n")
+
+
+# Runs bkmgr.py once and returns the run record it wrote to the metrics
+# directory, with the wall time including interpreter startup
+def runBkmgr(options: list, env: dict, metricsDir: str) -> dict:
+    for path in glob.glob(os.path.join(metricsDir, "*")):
+        os.unlink(path)
+    command = [sys.executable, BKMGR, "--metrics-dir", metricsDir] + options
+    started = time.monotonic()
+    res = subprocess.run(command, capture_output=True, text=True, env=env)
+    wall = time.monotonic() - started
+    records = glob.glob(os.path.join(metricsDir, "*.json"))
+    if res.returncode != 0 or not records:
+        raise ChildProcessError(f"bkmgr failed ({res.returncode}): {res.stderr.strip()}")
+    with open(records[0], "r") as f:
+        record = json.load(f)
+    record["wall"] = wall
+    return record
+
+
+# Backs up a freshly built filesystem `runs` times, the first run is full,
+# the later ones are incremental after `churnShare` of the files changed
+def scenario(args, backend: str, borg: str) -> list:
+    workDir = tempfile.mkdtemp(prefix="bkmgr-bench-", dir=args.work_dir)
+    env = dict(os.environ)
+    if borg == "stub":
+        env["PATH"] = STUB_DIR + os.pathsep + env.get("PATH", "")
+    results = []
+    try:
+        with filesystem(backend, workDir, args.size) as (source, dataPath):
+            logging.warning(f"Filling {backend} filesystem with {args.files} files...")
+            started = time.monotonic()
+            fill(dataPath, args.files, args.data * 1024 * 1024, args.seed)
+            os.sync()
+            fillTime = time.monotonic() - started
+            target = os.path.join(workDir, "target")
+            metricsDir = os.path.join(workDir, "metrics")
+            os.makedirs(target)
+            os.makedirs(metricsDir)
+            options = [source, target, "--mount-root", os.path.join(workDir, "run")]
+            if backend == "lvm":
+                options += ["--lvm", "--cow-size", "1"]
+            options += args.bkmgr_args
+            for run in range(args.runs):
+                if run:
+                    churn(dataPath, args.churn, args.seed + run)
+                if args.drop_caches:
+                    dropCaches()
+                logging.warning(f"Run {run + 1}/{args.runs}: {backend} with {borg} borg")
+                record = runBkmgr(options, env, metricsDir)
+                results.append({
+                    "backend": backend,
+                    "borg": borg,
+                    "run": run,
+                    "kind": "incremental" if run else "full",
+                    "fillSeconds": fillTime,
+                    "wall": record["wall"],
+                    "duration": record["duration"],
+                    "status": record["status"],
+                    "phases": record["phases"],
+                    "stats": record["stats"],
+                })
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+    return results
+
+
+def gitCommit() -> dict:
+    try:
+        commit = _run(["git", "-C", REPO_DIR, "rev-parse", "HEAD"]).strip()
+        dirty = bool(_run(["git", "-C", REPO_DIR, "status", "--porcelain", "--untracked-files=no"]))
+    except (ChildProcessError, FileNotFoundError):
+        return {"commit": None, "dirty": None}
+    return {"commit": commit, "dirty": dirty}
+
+
+# Why a scenario cannot run here, or None
+def unavailable(backend: str, borg: str):
+    missing = [tool for tool in ("losetup",) + _TOOLS[backend] if not shutil.which(tool)]
+    if missing:
+        return f"missing {', '.join(missing)}"
+    if borg == "real" and not shutil.which("borg"):
+        return "borg is not installed"
+    return None
+
+
+def bench(args) -> dict:
+    report = {
+        **gitCommit(),
+        "started": time.time(),
+        "host": {
+            "kernel": platform.release(),
+            "cpus": os.cpu_count(),
+            "python": platform.python_version(),
+        },
+        "config": {
+            "sizeMiB": args.size,
+            "dataMiB": args.data,
+            "files": args.files,
+            "runs": args.runs,
+            "churn": args.churn,
+            "seed": args.seed,
+            "dropCaches": args.drop_caches,
+            "bkmgrArgs": args.bkmgr_args,
+        },
+        "results": [],
+        "skipped": [],
+    }
+    for backend in args.backend:
+        for borg in args.borg:
+            reason = unavailable(backend, borg)
+            if reason is None:
+                try:
+                    report["results"] += scenario(args, backend, borg)
+                    continue
+                except (ChildProcessError, OSError) as ex:
+                    logging.exception(f"Scenario {backend} with {borg} borg failed:")
+                    reason = str(ex)
+            logging.warning(f"Skipping {backend} with {borg} borg: {reason}")
+            report["skipped"].append({"backend": backend, "borg": borg, "reason": reason})
+    return report
+
+
+# Median seconds per (backend, borg, kind, phase) over the results of a
+# report, "wall" being the whole bkmgr process
+def summary(report: dict) -> dict:
+    samples = {}
+    for result in report["results"]:
+        key = (result["backend"], result["borg"], result["kind"])
+        for phase, seconds in list(result["phases"].items()) + [("wall", result["wall"])]:
+            samples.setdefault(key + (phase,), []).append(seconds)
+    return {key: statistics.median(values) for key, values in samples.items()}
+
+
+# Prints the medians of two reports side by side
+def compare(basePath: str, newPath: str):
+    reports = []
+    for path in (basePath, newPath):
+        with open(path, "r") as f:
+            reports.append(json.load(f))
+    base, new = (summary(report) for report in reports)
+    print(f"{'backend':8} {'borg':5} {'kind':12} {'phase':22} " +
+          f"{(reports[0]['commit'] or '?')[:10]:>10} {(reports[1]['commit'] or '?')[:10]:>10} {'change':>8}")
+    for key in sorted(set(base) | set(new)):
+        old, now = base.get(key), new.get(key)
+        change = f"{(now - old) / old * 100:+7.1f}%" if old and now is not None else ""
+        print(f"{key[0]:8} {key[1]:5} {key[2]:12} {key[3]:22} " +
+              f"{'' if old is None else f'{old:10.3f}':>10} " +
+              f"{'' if now is None else f'{now:10.3f}':>10} {change:>8}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark bkmgr on throwaway loop device backed filesystems",
+        epilog="Options after -- are passed on to bkmgr.py")
+    parser.add_argument("-b", "--backend", choices=BACKENDS, action="append",
+                        help="Snapshot backend to benchmark, may be given more than once. " +
+                        "Defaults to all")
+    parser.add_argument("--borg", choices=BORGS, action="append",
+                        help="Benchmark with the real borg or with a stub that only walks " +
+                        "the source, to measure bkmgr's own overhead. Defaults to both")
+    parser.add_argument("-s", "--size", metavar="MIB", type=int, default=1024,
+                        help="Size of the filesystems. Defaults to 1024")
+    parser.add_argument("--data", metavar="MIB", type=int,
+                        help="Amount of synthetic data. Defaults to half the size")
+    parser.add_argument("--files", metavar="N", type=int, default=10000,
+                        help="Number of synthetic files. Defaults to 10000")
+    parser.add_argument("-r", "--runs", metavar="N", type=int, default=3,
+                        help="Backups per scenario, all but the first are incremental. " +
+                        "Defaults to 3")
+    parser.add_argument("--churn", metavar="SHARE", type=float, default=0.05,
+                        help="Share of files rewritten before each incremental backup. " +
+                        "Defaults to 0.05")
+    parser.add_argument("--seed", metavar="N", type=int, default=0,
+                        help="Seed of the synthetic data. Defaults to 0")
+    parser.add_argument("--drop-caches", action="store_true",
+                        help="Drop the page cache before each backup")
+    parser.add_argument("--work-dir", metavar="DIR", default="/var/tmp",
+                        help="Directory for the loop device images, repos and mounts. " +
+                        "Defaults to /var/tmp")
+    parser.add_argument("-o", "--output", metavar="FILE",
+                        help="Where to write the JSON report. " +
+                        "Defaults to bench-<commit>-<time>.json")
+    parser.add_argument("--compare", metavar="REPORT", nargs=2,
+                        help="Print the median phase times of two reports instead")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="Enable verbose logging")
+    parser.add_argument("-d", "--debug", action="store_true",
+                        help="Enable debug logging")
+    parser.add_argument("bkmgr_args", nargs=argparse.REMAINDER, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+    elif args.verbose:
+        logging.basicConfig(level=logging.INFO)
+    if args.compare:
+        compare(*args.compare)
+        exit(0)
+    if os.geteuid() != 0:
+        raise PermissionError("Loop devices, LVM and mounts require root")
+    args.backend = args.backend or list(BACKENDS)
+    args.borg = args.borg or list(BORGS)
+    args.data = args.data if args.data is not None else args.size // 2
+    if args.bkmgr_args[:1] == ["--"]:
+        args.bkmgr_args = args.bkmgr_args[1:]
+    if args.size <= 0 or args.files <= 0 or args.runs <= 0:
+        raise ValueError("Size, files and runs must be greater than 0")
+    if not 0 <= args.data < args.size:
+        raise ValueError("The data must fit into the filesystems")
+    if not 0 <= args.churn <= 1:
+        raise ValueError("'Churn' must be between 0 and 1")
+    report = bench(args)
+    output = args.output or \
+        f"bench-{(report['commit'] or 'unknown')[:10]}-{time.strftime('%Y%m%d%H%M%S')}.json"
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    logging.warning(f"Wrote {len(report['results'])} results to {output}")
+    if not report["results"]:
+        exit(1)
@@ -3,62 +3,746 @@
 import argparse
 import logging
 
-import io
+import asyncio
+import contextlib
+import json
 import os
+import tempfile
 import time
 import uuid
 
 import util
+import util.cache as cache
+import util.cgroup as cgroup
+import util.cow as cow
+import util.daemon as daemon
 import util.handlers as handlers
+import util.jobs as jobs
+import util.metrics as metrics
+import util.prescan as prescan
+import util.runner as runner
+import util.state as state
+import util.sysinfo as sysinfo
+import util.tuning as tuning
+import checkRepo
 import createArchive
 import createRepo
+import pruneRepo
 
 APP_DESCRIPTION = "Borg Backup Manager"
+DEFAULT_MOUNT_ROOT = "/run/bkmgr"
 
 
-def makeBackup(repoPath: str, sourcePath: str):
-    createArchive.createArchive(
-        repoPath, r"{hostname}-{now}", sourcePath)
+# Archives are named `prefix`{hostname}-{now}. With `rules` set, what they
+# match is left out, and with `prescanWorkers` the source is walked first.
+def makeBackup(repoPath: str, sourcePath: str, filesCache: str = None, paths=None,
+               sourceState: dict = None, cacheDir: str = None, roots=None,
+               prefix: str = "", rules=None, prescanWorkers: int = None,
+               prescanTime: float = None):
+    name = prefix + r"{hostname}-{now}"
+    # Archives holding only changed files are told apart by their name
+    if paths is not None:
+        name += pruneRepo.CHANGED_SUFFIX
+    sourceState = sourceState or {}
+    excludes = []
+    expectedBytes = None
+    if rules is not None:
+        excludes = list(rules.patterns)
+        # A list of changed paths is short, there is nothing to estimate
+        if prescanWorkers and paths is None:
+            result = prescan.scan(sourcePath, rules, roots, prescanWorkers, prescanTime)
+            excludes += result.excludes
+            expectedBytes = result.expectedBytes
+            metrics.annotate(expectedBytes=result.expectedBytes,
+                             expectedFiles=result.expectedFiles)
+    with tempfile.NamedTemporaryFile("w", prefix="bkmgr-excludes-") as excludeFile:
+        excludeFile.write("".join(f"{pattern}\n" for pattern in excludes))
+        excludeFile.flush()
+        createArchive.createArchive(
+            repoPath, name, sourcePath, filesCache=filesCache, paths=paths,
+            compression=sourceState.get("compression"),
+            chunkerParams=sourceState.get("chunkerParams"), cacheDir=cacheDir,
+            roots=roots, excludeFile=excludeFile.name if excludes else None,
+            excludeCaches=rules is not None and rules.excludeCaches,
+            expectedBytes=expectedBytes)
 
 
-def makeRepo(rootPath, lockFilePath):
-    path = time.strftime(r"%Y-%m-%d_%H:%M:%S")
+# The options of the job makeBackup needs: how its archives are named, what
+# they leave out and whether the source is prescanned first
+def archiveOptions(args) -> dict:
+    return {
+        "prefix": archivePrefix(args.source),
+        "rules": excludeRules(args),
+        "prescanWorkers": args.prescan_workers if args.prescan else None,
+        "prescanTime": args.prescan_time,
+    }
+
+
+# What the job leaves out of its archives, None if nothing
+def excludeRules(args):
+    if not args.exclude and not args.exclude_caches and not args.prescan:
+        return None
+    maxFileSize = None
+    if args.exclude_larger_than is not None:
+        maxFileSize = args.exclude_larger_than * 1024 ** 2
+    return prescan.Rules(args.exclude, maxFileSize, args.exclude_caches)
+
+
+# Benchmarks compression on a sample of the (mounted) source and remembers
+# the outcome for this and all later backups of it
+def tuneSource(args, sourceState: dict, sourcePath: str):
+    try:
+        compression, chunkerParams = tuning.tune(
+            sourcePath, args.tune_sample, args.tune_min_throughput)
+    except ValueError as ex:
+        logging.warning(f"Keeping the previous settings, tuning failed: {ex}")
+        return
+    previous = sourceState.get("chunkerParams", tuning.DEFAULT_CHUNKER)
+    if chunkerParams != previous:
+        logging.warning(
+            f"Chunker parameters changed from {previous} to {chunkerParams}, " +
+            "the next archive will not deduplicate against older ones")
+    sourceState["compression"] = compression
+    sourceState["chunkerParams"] = chunkerParams
+    sourceState["tuned"] = time.time()
+
+
+# Files changed since the last backup of the source according to BTRFS
+# generation numbers, or None if a full walk of the snapshot is due. It is
+# due when there is no usable base in the current repo yet and periodically,
+# because find-new does not see deletions and metadata-only changes.
+def changedPaths(snapshot, sourceState: dict, repoName: str, fullWalkInterval: int):
+    if sourceState.get("generation") is None or sourceState.get("repo") != repoName:
+        logging.info("No previous generation recorded in this repo, walking the whole snapshot")
+        return None
+    if time.time() - sourceState.get("lastFullWalk", 0) >= fullWalkInterval * 86400:
+        logging.info("Periodic full walk of the snapshot is due")
+        return None
+    paths = snapshot.findNew(sourceState["generation"])
+    logging.info(
+        f"{len(paths)} files changed since generation {sourceState['generation']}")
+    return paths
+
+
+# File name friendly, stable name of a source
+def sourceSlug(sourcePath: str) -> str:
+    return util.slug(sourcePath)
+
+
+# Archives of a source are named <prefix>{hostname}-{now}, so that the
+# sources sharing a repo are pruned separately. Slugs have no dashes, the
+# prefix of one source never matches the archives of another.
+def archivePrefix(sourcePath: str) -> str:
+    return f"{sourceSlug(sourcePath)}-"
+
+
+# Deterministic mountpoint for the snapshots of a given source, so that borg
+# sees the same absolute paths on every run and its files cache stays valid
+def stableMountpoint(mountRoot: str, sourcePath: str) -> str:
+    return os.path.join(mountRoot, sourceSlug(sourcePath))
+
+
+def makeRepo(rootPath, runState: state.State, cacheRoot: str = None):
+    path = time.strftime(state.REPO_NAME_FORMAT)
     logging.info(f"Creating new repo directory: {path}")
     repoPath = os.path.join(rootPath, path)
     os.mkdir(repoPath)
-    createRepo.createRepo(repoPath)
-    with open(lockFilePath, "w") as f:
-        f.write(path)
-        f.write(os.linesep)
-    logging.info("Lock file updated")
+    createRepo.createRepo(repoPath, repoCacheDir(cacheRoot, rootPath, path))
+    runState.currentRepo = path
+    runState.save()
+    logging.info("State updated")
+
+
+# Why the current repo has to be replaced by a new one according to the
+# rotation policy of the job, None if it does not. The age of a repo comes
+# from its name, its archives and their size from the run log.
+def rotationReason(args, runState: state.State) -> str:
+    repoName = runState.currentRepo
+    if args.rotate_days:
+        created = state.repoTime(repoName)
+        if created is None:
+            created = os.stat(os.path.join(args.target, repoName)).st_mtime
+        if time.time() - created >= args.rotate_days * 86400:
+            return f"it is older than {args.rotate_days} days"
+    if not args.rotate_archives and not args.rotate_size:
+        return None
+    runs = [record for record in runState.runs(repoName=repoName)
+            if record.get("status") == "success" and record.get("archive")]
+    if args.rotate_archives and len(runs) >= args.rotate_archives:
+        return f"it holds {len(runs)} archives"
+    size = sum(record.get("deduplicatedSize") or 0 for record in runs)
+    if args.rotate_size and size >= args.rotate_size * 1024 ** 3:
+        return f"it holds {runner.formatBytes(size)} of deduplicated data"
+    return None
+
+
+# Managed borg cache directory of a repo, None to leave it to borg. It is
+# created and marked as used on the way.
+def repoCacheDir(cacheRoot: str, targetPath: str, repoName: str) -> str:
+    if not cacheRoot:
+        return None
+    path = cache.cacheDir(cacheRoot, targetPath, repoName)
+    cache.borgEnv(path)
+    return path
+
+
+# The record of a finished run kept in the state's run log
+def runRecord(args, runMetrics: metrics.RunMetrics) -> dict:
+    record = runMetrics.record()
+    return {
+        "source": os.path.abspath(args.source),
+        "repo": record["details"].get("repo"),
+        "backend": record["details"].get("backend"),
+        "archive": record["archive"],
+        "started": record["started"],
+        "duration": record["duration"],
+        "status": record["status"],
+        "originalSize": record["stats"].get("original_size"),
+        "compressedSize": record["stats"].get("compressed_size"),
+        "deduplicatedSize": record["stats"].get("deduplicated_size"),
+        "files": record["stats"].get("nfiles"),
+    }
+
+
+# Checks a job for conflicting options and invalid values and fills in
+# the defaults that depend on other options
+def validateJob(args):
+    if not isinstance(args.group, list):
+        raise ValueError("'Group' must be a list of sources")
+    if args.group and args.btrfs_find_new:
+        raise ValueError("'BTRFS find-new' option is not valid with a group")
+    if args.exclude_larger_than is not None and not args.prescan:
+        raise ValueError("'Exclude Larger Than' requires a pre-scan")
+    if args.prescan_workers <= 0 or args.prescan_time <= 0:
+        raise ValueError("Pre-scan workers and time must be greater than 0")
+    if args.verify_only and not args.verify_budget:
+        raise ValueError("'Verify Only' requires a verification budget")
+    if (args.verify_budget is not None and args.verify_budget <= 0) \
+            or args.verify_period <= 0 or args.verify_workers <= 0:
+        raise ValueError("Verification budget, period and workers must be greater than 0")
+    if args.interval <= 0:
+        raise ValueError("'Interval' must be greater than 0")
+    if args.fsfreeze and not (args.group and args.lvm):
+        raise ValueError("'FS Freeze' option is only valid with a group of LVM volumes")
+    if args.lvm and args.btrfs_find_new:
+        raise ValueError("'BTRFS find-new' option is not valid with LVM as backend")
+    if not args.lvm and (args.cow_size or args.no_cow or args.cow_max):
+        # cow_size is meaningless if lvm is not set so the default doesn't matter
+        raise ValueError(
+            "'COW Size' and 'No Cow' options are only valid when using LVM as backend")
+    elif (args.cow_size or args.cow_max) and args.no_cow:
+        raise ValueError(
+            "'COW Size' and 'No Cow' options are mutually exclusive")
+    if (args.cache_budget is not None or args.prewarm) and not args.cache_root:
+        raise ValueError("'Cache Budget' and 'Prewarm' require a cache root")
+    for option in ("rotate_days", "rotate_archives", "rotate_size", "keep_repos",
+                   *(f"keep_{period}" for period in pruneRepo.KEEP_PERIODS)):
+        if getattr(args, option) is not None and getattr(args, option) <= 0:
+            raise ValueError(f"'{option}' must be greater than 0")
+    if args.cache_budget is not None and args.cache_budget < 0:
+        raise ValueError("'Cache Budget' must not be negative")
+    if not 0 < args.tune_sample <= 1:
+        raise ValueError("'Tune Sample' must be between 0 and 1")
+    if args.readahead_kb < 0:
+        raise ValueError("'Readahead' must not be negative")
+    # Without cow_size the size is estimated at snapshot time
+    if args.cow_size is not None and args.cow_size <= 0:
+        raise ValueError("'COW Size' must be greater than 0")
+    if args.cow_max is not None and args.cow_max <= 0:
+        raise ValueError("'COW Max' must be greater than 0")
+    if not 0 < args.cow_extend_at < 100:
+        raise ValueError("'COW Extend At' must be between 0 and 100")
+    # Unset cow_size if no_cow is set
+    if args.no_cow:
+        args.cow_size = None
+
+
+# Backs up a single source to its target while recording how long each
+# phase takes. With `metrics_dir` set the figures are written there as a
+# node_exporter textfile and a JSON run record once the job is over.
+def runJob(args):
+    if args.verify_only:
+        verify(args)
+        return
+    runMetrics = metrics.start({
+        "source": os.path.abspath(args.source),
+        "target": os.path.abspath(args.target),
+    })
+    throttle = contextlib.nullcontext()
+    if args.throttle:
+        try:
+            throttle = cgroup.Throttle(
+                f"{sourceSlug(args.source)}.scope", args.pressure_high, args.pressure_low)
+        except FileNotFoundError as ex:
+            logging.warning(f"Running without throttling: {ex}")
+    # Holding the state locks TARGET for the whole run
+    with state.State(args.target) as runState:
+        try:
+            with runMetrics.phase("total"), throttle:
+                if args.prewarm:
+                    prewarm(args, runState)
+                else:
+                    backup(args, runState)
+        except BaseException:
+            runMetrics.finish("failed")
+            raise
+        else:
+            runMetrics.finish("success")
+        finally:
+            try:
+                runState.recordRun(runRecord(args, runMetrics))
+                runState.save()
+            except OSError:
+                logging.exception("Failed to record the run:")
+            if args.metrics_dir:
+                name = f"bkmgr_{sourceSlug(args.source)}"
+                try:
+                    runMetrics.write(
+                        os.path.join(args.metrics_dir, f"{name}.prom"),
+                        os.path.join(args.metrics_dir, f"{name}.json"))
+                except OSError:
+                    logging.exception("Failed to write metrics:")
+    # Started once TARGET is unlocked, it may have to remove old repos
+    if not args.prewarm and (args.keep_repos or any(keepPolicy(args).values())):
+        try:
+            pruneRepo.spawn(args.target, runState.currentRepo, keepPolicy(args),
+                            args.keep_repos, args.cache_root,
+                            logging.root.level <= logging.INFO,
+                            f"{archivePrefix(args.source)}*")
+        except OSError:
+            logging.exception("Failed to start pruning:")
+    if args.verify_budget:
+        verify(args)
+
+
+# Verifies the archives below TARGET within the job's time budget and logs
+# the run like a backup, its metrics go next to those of the backups
+def verify(args):
+    runMetrics = metrics.start({"target": os.path.abspath(args.target)})
+    try:
+        with runMetrics.phase("total"):
+            checkRepo.verifyTarget(args.target, args.verify_budget * 60,
+                                   args.verify_period, args.verify_workers)
+    except BaseException:
+        runMetrics.finish("failed")
+        raise
+    else:
+        runMetrics.finish("success")
+    finally:
+        record = runMetrics.record()
+        try:
+            state.State(args.target).recordRun({
+                "action": "verify",
+                "source": os.path.abspath(args.source) if args.source else None,
+                "started": record["started"],
+                "duration": record["duration"],
+                "status": record["status"],
+                "verifiedShare": record["details"].get("verifiedShare"),
+            })
+        except OSError:
+            logging.exception("Failed to record the run:")
+        if args.metrics_dir:
+            name = f"bkmgr_verify_{util.slug(args.target)}"
+            try:
+                runMetrics.write(
+                    os.path.join(args.metrics_dir, f"{name}.prom"),
+                    os.path.join(args.metrics_dir, f"{name}.json"))
+            except OSError:
+                logging.exception("Failed to write metrics:")
+
 
+# Retention of archives in the current repo, see pruneRepo.KEEP_PERIODS
+def keepPolicy(args) -> dict:
+    return {period: getattr(args, f"keep_{period}") for period in pruneRepo.KEEP_PERIODS}
 
-def getCurrentRepoHandle(basePath, handlePath: str) -> io.TextIOWrapper:
-    if not util.exists(handlePath):
-        raise FileNotFoundError(f"Path does not exist: {handlePath}")
-    if not util.readable(handlePath) or not util.fileWriteable(handlePath):
-        raise PermissionError(f"User lacks required permissions: {handlePath}")
-    return open(handlePath, "r+")
+
+# Builds the borg cache of the current repo ahead of the next backup and
+# evicts caches of other repos beyond the budget
+def prewarm(args, runState: state.State):
+    repoName = runState.currentRepo
+    if not repoName:
+        raise FileNotFoundError(f"There is no repo in {args.target} yet")
+    metrics.annotate(repo=repoName, action="prewarm")
+    cachePath = repoCacheDir(args.cache_root, args.target, repoName)
+    cache.prewarm(os.path.join(args.target, repoName), cachePath)
+    evictCaches(args, cachePath)
+
+
+def evictCaches(args, cachePath: str):
+    if args.cache_budget is None:
+        return
+    try:
+        cache.evict(args.cache_root, args.cache_budget * 1024 ** 3, [cachePath])
+    except OSError:
+        logging.exception("Failed to evict borg caches:")
+
+
+# COW snapshot size in GiB for an LVM source: the requested one, None for
+# thin snapshots or else an estimate from its write rate
+def cowSize(args, sourcePath: str, sourceState: dict) -> int:
+    if args.cow_size or args.no_cow:
+        return args.cow_size
+    previous = None
+    if "writeSectors" in sourceState:
+        previous = (sourceState["writeSectors"], sourceState["writeTime"])
+    return cow.estimateSize(
+        sourcePath, sourceState.get("duration", cow.DEFAULT_DURATION),
+        previous, maximum=args.cow_max)
+
+
+# What the next estimate of the COW size is based on
+def recordWrites(sourcePath: str, sourceState: dict, duration: float):
+    sourceState["duration"] = duration
+    sourceState["writeSectors"] = cow.sectorsWritten(sourcePath)
+    sourceState["writeTime"] = time.time()
+
+
+# Mountpoint of the filesystem on an LVM source, for fsfreeze
+def freezePath(sourcePath: str) -> str:
+    mounts = sysinfo.lookup(lambda idx: idx.mountsOfDevice(sourcePath))
+    if not mounts:
+        raise ValueError(f"{sourcePath} is not mounted, there is nothing to freeze")
+    return mounts[0].mountpoint
+
+
+# Backs up the source together with the other members of its group: all
+# snapshots are taken at once, mounted side by side below the mountpoint of
+# the source and archived by a single borg run
+def backupGroup(args, runState: state.State, repoPath: str, cachePath: str):
+    sources = [args.source, *args.group]
+    names = [sourceSlug(source) for source in sources]
+    if len(set(names)) != len(names):
+        raise ValueError(f"The group lists a source more than once: {sources}")
+    groupRoot = stableMountpoint(args.mount_root, args.source)
+    if args.lvm:
+        metrics.annotate(backend="lvm", group=len(sources))
+        members = [handlers.LVMSnap(source, "bkmgrsnap" + uuid.uuid4().hex,
+                                    cowSize(args, source, runState.source(source)))
+                   for source in sources]
+        filesCache = handlers.LVMSnap.filesCache
+    else:
+        # Unlike a single source a group cannot fall back to a direct backup,
+        # it would not be consistent
+        metrics.annotate(backend="btrfs", group=len(sources))
+        members = [handlers.BTRFSSnap(source, "bkmgrsnap" + uuid.uuid4().hex)
+                   for source in sources]
+        filesCache = handlers.BTRFSSnap.filesCache
+    freezePaths = [freezePath(source) for source in sources] if args.fsfreeze else None
+    started = time.time()
+    with handlers.SnapshotGroup(members, freezePaths) as group, \
+            contextlib.ExitStack() as stack:
+        for name, member in zip(names, group.members):
+            mountpoint = os.path.join(groupRoot, name)
+            if args.lvm:
+                if member.cowSize:
+                    stack.enter_context(cow.CowMonitor(
+                        member.volumeGroup, member.snapshotName, args.cow_extend_at))
+                mountpointHandle = handlers.Mount(
+                    os.path.join(os.path.sep, "dev", member.volumeGroup, member.snapshotName),
+                    mountpoint=mountpoint, skipRecovery=True,
+                    readaheadKb=args.readahead_kb)
+            else:
+                mountpointHandle = handlers.Mount(
+                    member.snapshotRootDevice, f"subvol={member.subvolPath}", mountpoint)
+            stack.enter_context(mountpointHandle)
+        sourceState = runState.source(args.source)
+        if args.tune:
+            tuneSource(args, sourceState, os.path.join(groupRoot, names[0]))
+        logging.warning(f"Backing up a group of {len(sources)} snapshots...")
+        makeBackup(repoPath, groupRoot, filesCache, sourceState=sourceState,
+                   cacheDir=cachePath, roots=names, **archiveOptions(args))
+    if args.lvm:
+        for source in sources:
+            recordWrites(source, runState.source(source), time.time() - started)
+    runState.save()
+
+
+# Backs up a single source to its target: snapshot -> mount -> archive
+def backup(args, runState: state.State):
+    # Create new repo if requested, if there is none yet or if the rotation
+    # policy calls for one
+    if args.create_repo or not runState.currentRepo:
+        makeRepo(args.target, runState, args.cache_root)
+    else:
+        reason = rotationReason(args, runState)
+        if reason:
+            logging.warning(f"Starting a new repo, {runState.currentRepo} is due: {reason}")
+            makeRepo(args.target, runState, args.cache_root)
+    repoName = runState.currentRepo
+    repoPath = os.path.join(args.target, repoName)
+    cachePath = repoCacheDir(args.cache_root, args.target, repoName)
+    metrics.annotate(repo=repoName)
+    if not util.exists(repoPath):
+        raise FileNotFoundError(f"Path does not exist: {repoPath}")
+    if not util.exists(args.source):
+        raise FileNotFoundError(f"Path does not exist: {args.source}")
+    sourceState = runState.source(args.source)
+    if args.group:
+        backupGroup(args, runState, repoPath, cachePath)
+    elif args.lvm:
+        metrics.annotate(backend="lvm")
+        size = cowSize(args, args.source, sourceState)
+        snaphotHandle = handlers.LVMSnap(
+            args.source, "bkmgrsnap" + uuid.uuid4().hex, size)
+        started = time.time()
+        with snaphotHandle:
+            monitor = contextlib.nullcontext()
+            # Thin snapshots have no COW area to watch
+            if size:
+                monitor = cow.CowMonitor(
+                    snaphotHandle.volumeGroup, snaphotHandle.snapshotName,
+                    args.cow_extend_at)
+            mountpointHandle = handlers.Mount(
+                os.path.join(
+                    os.path.sep, "dev",
+                    snaphotHandle.volumeGroup, snaphotHandle.snapshotName
+                ),
+                mountpoint=stableMountpoint(args.mount_root, args.source),
+                skipRecovery=True, readaheadKb=args.readahead_kb
+            )
+            with monitor, mountpointHandle:
+                if args.tune:
+                    tuneSource(args, sourceState, mountpointHandle.mountpoint)
+                logging.warning("Backing up via LVM snapshot...")
+                makeBackup(repoPath, mountpointHandle.mountpoint,
+                           handlers.LVMSnap.filesCache, sourceState=sourceState,
+                           cacheDir=cachePath, **archiveOptions(args))
+        recordWrites(args.source, sourceState, time.time() - started)
+        runState.save()
+    else:
+        # Check if BTRFS snapshot is available
+        try:
+            snaphotHandle = handlers.BTRFSSnap(
+                args.source, "bkmgrsnap" + uuid.uuid4().hex)
+        except (ValueError, ChildProcessError) as ex:
+            logging.debug("BTRFS snapshot not available:")
+            logging.debug(f"\t{str(ex)}")
+            logging.warning("Proceeding with direct backup...")
+            metrics.annotate(backend="direct")
+            if args.tune:
+                tuneSource(args, sourceState, args.source)
+            makeBackup(repoPath, args.source, sourceState=sourceState, cacheDir=cachePath,
+                       **archiveOptions(args))
+            if args.tune:
+                runState.save()
+        else:
+            metrics.annotate(backend="btrfs")
+            with snaphotHandle:
+                mountpointHandle = handlers.Mount(
+                    snaphotHandle.snapshotRootDevice,
+                    f"subvol={snaphotHandle.subvolPath}",
+                    stableMountpoint(args.mount_root, args.source)
+                    )
+                with mountpointHandle:
+                    if args.tune:
+                        tuneSource(args, sourceState, mountpointHandle.mountpoint)
+                    logging.warning("Backing up via BTRFS snapshot...")
+                    paths = None
+                    if args.btrfs_find_new:
+                        paths = changedPaths(
+                            snaphotHandle, sourceState, repoName,
+                            args.full_walk_interval)
+                        generation = snaphotHandle.generation()
+                    if paths == []:
+                        logging.warning("Nothing changed since the last backup")
+                    else:
+                        makeBackup(repoPath, mountpointHandle.mountpoint,
+                                   handlers.BTRFSSnap.filesCache, paths, sourceState,
+                                   cachePath, **archiveOptions(args))
+                    if args.btrfs_find_new:
+                        # Only a successful backup may become the next base
+                        sourceState["generation"] = generation
+                        sourceState["repo"] = repoName
+                        if paths is None:
+                            sourceState["lastFullWalk"] = time.time()
+                    if args.btrfs_find_new or args.tune:
+                        runState.save()
+    logging.warning(f"Successfuly backed up {args.source} to {repoPath}")
+    evictCaches(args, cachePath)
+
+
+# Wraps the jobs for the daemon, which picks up where the run log of their
+# TARGET left off
+def scheduleJobs(jobList: list) -> list:
+    scheduled = []
+    for job in jobList:
+        # Verify only jobs are due by their verification runs
+        action = "verify" if job.verify_only else None
+        runs = [record for record in state.State(job.target).runs(job.source)
+                if record.get("status") == "success" and record.get("action") == action]
+        lastRun = runs[-1]["started"] + runs[-1]["duration"] if runs else None
+        scheduled.append(daemon.ScheduledJob(
+            job, os.path.abspath(job.source), [job.source, *job.group], job.target,
+            job.interval * 60, lastRun))
+    return scheduled
+
+
+# Reads a JSON list of jobs. Every job is an object with `source` and
+# `target` plus any of the command line options, named like their
+# destination (e.g. `"lvm": true, "cow_size": 16`). Options not given
+# fall back to the command line defaults.
+def loadJobs(parser: argparse.ArgumentParser, jobsPath: str) -> list:
+    with open(jobsPath, "r") as f:
+        jobList = json.load(f)
+    if not isinstance(jobList, list):
+        raise ValueError(f"Job file must contain a list of jobs: {jobsPath}")
+    result = []
+    for job in jobList:
+        if "source" not in job or "target" not in job:
+            raise ValueError(f"Job is missing `source` or `target`: {job}")
+        args = parser.parse_args([job["source"], job["target"]])
+        for key, value in job.items():
+            if not hasattr(args, key) or key in (
+                    "jobs", "verbose", "debug", "daemon", "socket", "status", "run_now"):
+                raise ValueError(f"Unknown job option `{key}`: {job}")
+            setattr(args, key, value)
+        validateJob(args)
+        result.append(args)
+    return result
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=APP_DESCRIPTION)
-    parser.add_argument("source", metavar="SRC",
+    parser.add_argument("source", metavar="SRC", nargs="?",
                         help="Source directory containing data to backup")
-    parser.add_argument("target", metavar="TARGET",
+    parser.add_argument("target", metavar="TARGET", nargs="?",
                         help="Root directory the archives reside in")
+    parser.add_argument("-j", "--jobs", metavar="FILE",
+                        help="Back up every source listed in the JSON job file " +
+                        "FILE instead of a single SRC/TARGET pair")
+    parser.add_argument("--daemon", action="store_true",
+                        help="Keep running and back up every job of the job file " +
+                        "every --interval minutes, controlled through --socket")
+    parser.add_argument("--interval", metavar="MINUTES", type=int, default=1440,
+                        help="With --daemon, minutes between two backups of a job. " +
+                        "Defaults to 1440")
+    parser.add_argument("--socket", metavar="PATH", default=daemon.DEFAULT_SOCKET,
+                        help="UNIX socket of the daemon. " +
+                        f"Defaults to {daemon.DEFAULT_SOCKET}")
+    parser.add_argument("--status", action="store_true",
+                        help="Print the jobs and progress of a running daemon")
+    parser.add_argument("--run-now", metavar="SRC", nargs="?", const="",
+                        help="Have a running daemon back up SRC (all jobs without " +
+                        "SRC) right away")
+    parser.add_argument("--max-workers", metavar="N", type=int, default=os.cpu_count(),
+                        help="Maximum number of jobs running at the same time")
+    parser.add_argument("--per-source-device", metavar="N", type=int, default=1,
+                        help="Maximum number of jobs reading from the same disk. " +
+                        "Defaults to 1")
+    parser.add_argument("--per-target-device", metavar="N", type=int, default=1,
+                        help="Maximum number of jobs writing to the same disk. " +
+                        "Defaults to 1")
+    parser.add_argument("-g", "--group", metavar="SRC", action="append", default=[],
+                        help="Snapshot SRC at the same time as the main SRC and " +
+                        "archive both together, e.g. the data and the WAL volume " +
+                        "of a database. Can be given more than once")
+    parser.add_argument("--fsfreeze", action="store_true",
+                        help="Freeze the filesystems of an LVM group until all " +
+                        "of its snapshots are created")
     parser.add_argument("-l", "--lvm", action="store_true",
                         help="Use LVM snapshots to backup a filesystem on LVM volume")
     parser.add_argument("--cow-size", metavar="COW_SIZE", type=int,
                         help="Specify the size for a COW snapshot in GiB. " +
-                        "Defaults to 64GiB. Valid on both classic and thin " +
-                        "LVM volumes")
+                        "Defaults to an estimate based on the write rate of " +
+                        "the volume and the duration of the previous backup. " +
+                        "Valid on both classic and thin LVM volumes")
+    parser.add_argument("--cow-max", metavar="GIB", type=int,
+                        help="Upper limit for the estimated COW snapshot size. " +
+                        "The free space of the volume group always is one")
+    parser.add_argument("--cow-extend-at", metavar="PERCENT", type=float, default=80.0,
+                        help="Grow a COW snapshot by half its size once it is " +
+                        "PERCENT full. Defaults to 80")
     parser.add_argument("-n", "--no-cow", action="store_true",
                         help="Use LVM thin snapshots instead of COW snapshots. " +
                         "Valid only in on thin LVM volumes")
+    parser.add_argument("--mount-root", metavar="DIR", default=DEFAULT_MOUNT_ROOT,
+                        help="Directory under which snapshots are mounted, " +
+                        f"one fixed subdirectory per source. Defaults to {DEFAULT_MOUNT_ROOT}")
+    parser.add_argument("--readahead-kb", metavar="KIB", type=int, default=4096,
+                        help="Readahead of LVM snapshot devices while they are " +
+                        "backed up, 0 keeps the kernel default. Defaults to 4096")
+    parser.add_argument("--btrfs-find-new", action="store_true",
+                        help="Only archive files BTRFS reports as changed since " +
+                        "the previous snapshot instead of walking the whole tree")
+    parser.add_argument("--full-walk-interval", metavar="DAYS", type=int, default=7,
+                        help="With --btrfs-find-new, still archive the whole " +
+                        "snapshot every DAYS days. Defaults to 7")
+    parser.add_argument("--metrics-dir", metavar="DIR",
+                        help="Write per phase timings and borg statistics of every " +
+                        "job to DIR, as a node_exporter textfile (.prom) and as JSON")
+    parser.add_argument("--throttle", action="store_true",
+                        help="Run borg and lvcreate in a cgroup v2 whose IO and CPU " +
+                        "limits follow the pressure stall information of the host")
+    parser.add_argument("--pressure-high", metavar="PERCENT", type=float, default=10.0,
+                        help="With --throttle, tighten the limits when other tasks " +
+                        "stall for more than PERCENT of the time. Defaults to 10")
+    parser.add_argument("--pressure-low", metavar="PERCENT", type=float, default=2.0,
+                        help="With --throttle, relax the limits when other tasks " +
+                        "stall for less than PERCENT of the time. Defaults to 2")
+    parser.add_argument("--tune", action="store_true",
+                        help="Benchmark compression algorithms on a sample of the " +
+                        "source, pick compression and chunker parameters and use " +
+                        "them for this and all later backups of the source")
+    parser.add_argument("--tune-sample", metavar="FRACTION", type=float, default=0.01,
+                        help="Fraction of files sampled by --tune. Defaults to 0.01")
+    parser.add_argument("--tune-min-throughput", metavar="MIBPS", type=float,
+                        default=100.0,
+                        help="Slowest compression --tune may pick, in MiB/s per " +
+                        "core. Defaults to 100")
+    parser.add_argument("--cache-root", metavar="DIR",
+                        help="Keep a separate borg cache per repo below DIR " +
+                        "(ideally on fast local storage) instead of borg's default")
+    parser.add_argument("--cache-budget", metavar="GIB", type=int,
+                        help="With --cache-root, evict the least recently used " +
+                        "caches of other repos once all of them exceed GIB")
+    parser.add_argument("--prewarm", action="store_true",
+                        help="Only build the borg cache of the current repo, " +
+                        "e.g. outside the backup window, instead of backing up")
+    parser.add_argument("--rotate-days", metavar="N", type=int,
+                        help="Start a new repo once the current one is N days old")
+    parser.add_argument("--rotate-archives", metavar="N", type=int,
+                        help="Start a new repo once the current one holds N archives")
+    parser.add_argument("--rotate-size", metavar="GIB", type=int,
+                        help="Start a new repo once the archives in the current " +
+                        "one added GIB of deduplicated data")
+    for period in pruneRepo.KEEP_PERIODS:
+        parser.add_argument(f"--keep-{period}", metavar="N", type=int,
+                            help=f"Prune the current repo down to N {period} " +
+                            "archives after every backup")
+    parser.add_argument("--keep-repos", metavar="N", type=int,
+                        help="Remove all but the N newest repos (and their caches) " +
+                        "after every backup")
+    parser.add_argument("--exclude", metavar="PATTERN", action="append", default=[],
+                        help="Leave out paths matching the borg pattern PATTERN " +
+                        "(relative to SRC). Can be given more than once")
+    parser.add_argument("--exclude-caches", action="store_true",
+                        help="Leave out directories tagged with a CACHEDIR.TAG")
+    parser.add_argument("--prescan", action="store_true",
+                        help="Walk the snapshot before archiving it, to show a " +
+                        "percentage and ETA and to apply --exclude-larger-than")
+    parser.add_argument("--prescan-workers", metavar="N", type=int, default=8,
+                        help="Threads walking the snapshot. Defaults to 8")
+    parser.add_argument("--prescan-time", metavar="SECONDS", type=float, default=60.0,
+                        help="Stop walking after SECONDS and estimate the rest, " +
+                        "unless --exclude-larger-than is set. Defaults to 60")
+    parser.add_argument("--exclude-larger-than", metavar="MIB", type=int,
+                        help="With --prescan, leave out files larger than MIB. " +
+                        "The whole snapshot is walked to find them")
+    parser.add_argument("--verify-budget", metavar="MINUTES", type=float,
+                        help="After the backup, spend up to MINUTES verifying the " +
+                        "archives in TARGET that are due (see --verify-period)")
+    parser.add_argument("--verify-period", metavar="DAYS", type=float,
+                        default=checkRepo.DEFAULT_PERIOD,
+                        help="Verify every archive at least once in DAYS days, " +
+                        f"given enough budget. Defaults to {checkRepo.DEFAULT_PERIOD}")
+    parser.add_argument("--verify-workers", metavar="N", type=int, default=2,
+                        help="Number of repos verified at the same time. Defaults to 2")
+    parser.add_argument("--verify-only", action="store_true",
+                        help="Only verify the archives in TARGET, e.g. as a daemon " +
+                        "job on its own interval, instead of backing up SRC")
     parser.add_argument("-c", "--create-repo",
                         action="store_true",
-                        help="Create a new repo and update lockfile")
+                        help="Create a new repo and make it the current one")
     parser.add_argument("-v", "--verbose", action="store_true",
                         help="Enable verbose logging")
     parser.add_argument("-d", "--debug", action="store_true",
@@ -73,73 +757,42 @@ if __name__ == "__main__":
         logging.root.setLevel(logging.WARNING)
     # Gracefuly exit on unhandled exceptions
     try:
-        # Validate arguments for conflicting options and invalid values
-        if not args.lvm and (args.cow_size or args.no_cow):
-            # cow_size is meaningless if lvm is not set so the default doesn't matter
-            raise ValueError(
-                "'COW Size' and 'No Cow' options are only valid when using LVM as backend")
-        elif args.cow_size and args.no_cow:
-            raise ValueError(
-                "'COW Size' and 'No Cow' options are mutually exclusive")
-        # Assign a default to cow_size if it's not set
-        if not args.cow_size:
-            args.cow_size = 64
-        elif args.cow_size <= 0:
-            raise ValueError("'COW Size' must be greater than 0")
-        # Unset cow_size if no_cow is set
-        if args.no_cow:
-            args.cow_size = None
-
-        lockFilePath = os.path.join(args.target, "lock.txt")
-        # Create new repo if requested
-        if args.create_repo:
-            makeRepo(args.target, lockFilePath)
-        try:
-            lockFileHandle = getCurrentRepoHandle(args.target, lockFilePath)
-        except FileNotFoundError:
-            # If the lock file doesn't exist, create it
-            makeRepo(args.target, lockFilePath)
-            lockFileHandle = getCurrentRepoHandle(args.target, lockFilePath)
-        repoPath = os.path.join(args.target, lockFileHandle.read().strip())
-        if not util.exists(repoPath):
-            raise FileNotFoundError(f"Path does not exist: {repoPath}")
-        if not util.exists(args.source):
-            raise FileNotFoundError(f"Path does not exist: {args.source}")
-        if args.lvm:
-            with lockFileHandle:
-                snaphotHandle = handlers.LVMSnap(
-                    args.source, "bkmgrsnap" + uuid.uuid4().hex, args.cow_size)
-                with snaphotHandle:
-                    mountpointHandle = handlers.Mount(
-                        os.path.join(
-                            os.path.sep, "dev",
-                            snaphotHandle.volumeGroup, snaphotHandle.snapshotName
-                        )
-                    )
-                    with mountpointHandle:
-                        logging.warning("Backing up via LVM snapshot...")
-                        makeBackup(repoPath, mountpointHandle.mountpoint)
+        if args.status or args.run_now is not None:
+            message = {"command": "status"} if args.status else \
+                {"command": "run", "source": args.run_now or None}
+            response = daemon.request(args.socket, message)
+            if "error" in response:
+                raise ValueError(f"Daemon refused the request: {response['error']}")
+            print(json.dumps(response, indent=2))
+        elif args.daemon and not args.jobs:
+            raise ValueError("The daemon needs a job file")
+        elif args.jobs:
+            if args.source or args.target:
+                raise ValueError("SRC and TARGET cannot be combined with a job file")
+            if args.max_workers <= 0 or args.per_source_device <= 0 \
+                    or args.per_target_device <= 0:
+                raise ValueError("Concurrency limits must be greater than 0")
+            jobList = loadJobs(parser, args.jobs)
+            if args.daemon:
+                asyncio.run(daemon.Daemon(
+                    scheduleJobs(jobList), runJob, args.max_workers,
+                    args.per_source_device, args.per_target_device, args.socket).run())
+            else:
+                failed = jobs.runJobs(
+                    jobList, runJob,
+                    lambda job: job.source, lambda job: job.target,
+                    min(args.max_workers, len(jobList)) or 1,
+                    args.per_source_device, args.per_target_device,
+                    lambda job: [job.source, *job.group])
+                if failed:
+                    raise ChildProcessError(
+                        f"{len(failed)} of {len(jobList)} jobs failed: " +
+                        ", ".join(job.source for job in failed))
         else:
-            with lockFileHandle:
-                # Check if BTRFS snapshot is available
-                try:
-                    snaphotHandle = handlers.BTRFSSnap(
-                        args.source, "bkmgrsnap" + uuid.uuid4().hex)
-                except (ValueError, ChildProcessError) as ex:
-                    logging.debug("BTRFS snapshot not available:")
-                    logging.debug(f"\t{str(ex)}")
-                    logging.warning("Proceeding with direct backup...")
-                    makeBackup(repoPath, args.source)
-                else:
-                    with snaphotHandle:
-                        mountpointHandle = handlers.Mount(
-                            snaphotHandle.snapshotRootDevice,
-                            f"subvol={snaphotHandle.subvolPath}"
-                            )
-                        with mountpointHandle:
-                            logging.warning("Backing up via BTRFS snapshot...")
-                            makeBackup(repoPath, mountpointHandle.mountpoint)
-        logging.warning(f"Successfuly backed up {args.source} to {repoPath}")
+            if not args.source or not args.target:
+                parser.error("SRC and TARGET are required without a job file")
+            validateJob(args)
+            runJob(args)
     except BaseException:
         logging.exception("An unhandled exception has occurred:")
         logging.critical("Backup failed. Exiting on error...")
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+
+import concurrent.futures
+import contextvars
+import os
+import time
+
+import pruneRepo
+import util
+import util.metrics as metrics
+import util.runner as runner
+import util.state as state
+
+DEFAULT_PERIOD = 30
+
+
+# Reads back and verifies all data of an archive. Returns "ok", "failed"
+# or "timeout" if it did not finish within `timeout` seconds.
+def checkArchive(repoPath: str, name: str, timeout: float = None) -> str:
+    logging.info(f"Verifying {repoPath}::{name}")
+    with metrics.phase("borg_check"):
+        res = runner.runBorg(
+            "check", ["--archives-only", "--verify-data",
+                      "--lock-wait", str(runner.LOCK_WAIT), f"{repoPath}::{name}"],
+            timeout=timeout)
+    if res.timedOut:
+        return "timeout"
+    if res.returncode != 0:
+        logging.error(f"Verification of {repoPath}::{name} failed: {res.errorText()}")
+        return "failed"
+    logging.info(f"Verified {repoPath}::{name}")
+    return "ok"
+
+
+# Works through the due archives of one repo, most overdue first, until the
+# deadline. Returns {archive: (status, timestamp)} of those it got to.
+def _checkRepo(repoPath: str, names: list, deadline: float) -> dict:
+    results = {}
+    for name in names:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        status = checkArchive(repoPath, name, remaining)
+        if status == "timeout":
+            break
+        results[name] = (status, time.time())
+    return results
+
+
+# Verifies a rotating selection of the archives in all repos below TARGET
+# within `budget` seconds, one borg per repo and up to `workers` repos at a
+# time. The time every archive was last verified is kept in the state of
+# TARGET, archives not verified for `period` days (or never) go first, so
+# that with a large enough budget every archive is verified once per period.
+# Returns the share of archives verified within the period.
+def verifyTarget(targetPath: str, budget: float, period: float = DEFAULT_PERIOD,
+                 workers: int = 2) -> float:
+    targetPath = os.path.abspath(targetPath)
+    deadline = time.time() + budget
+    if not util.exists(targetPath):
+        raise FileNotFoundError(f"Path does not exist: {targetPath}")
+    os.environ["BORG_UNKNOWN_UNENCRYPTED_REPO_ACCESS_IS_OK"] = "yes"
+    coverage = state.State(targetPath).data.get("verified", {})
+    due = {}
+    covered = 0
+    total = 0
+    failed = []
+    for repoName in state.repoNames(targetPath):
+        verified = coverage.get(repoName, {})
+        # A repo locked for too long or being removed must not hold up the rest
+        try:
+            archives = pruneRepo.listArchives(os.path.join(targetPath, repoName))
+        except (ChildProcessError, OSError, ValueError):
+            if not util.exists(os.path.join(targetPath, repoName)):
+                logging.info(f"Skipping {repoName}, it was removed meanwhile")
+                continue
+            logging.exception(f"Failed to list the archives of {repoName}:")
+            failed.append(repoName)
+            continue
+        total += len(archives)
+        # Never verified ones first, then the longest ago verified
+        pending = sorted(
+            (verified.get(name, {}).get("time", 0), name) for name in archives
+            if verified.get(name, {}).get("status") != "ok"
+            or verified[name]["time"] < time.time() - period * 86400)
+        covered += len(archives) - len(pending)
+        if pending:
+            due[repoName] = [name for _, name in pending]
+    logging.info(
+        f"{sum(map(len, due.values()))} of {total} archives in {len(due)} repos " +
+        "are due for verification")
+    results = {}
+    # The repo with the most overdue archive starts first
+    order = sorted(due, key=lambda repoName: min(
+        coverage.get(repoName, {}).get(name, {}).get("time", 0)
+        for name in due[repoName]))
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        futures = {
+            pool.submit(contextvars.copy_context().run, _checkRepo,
+                        os.path.join(targetPath, repoName), due[repoName], deadline):
+            repoName for repoName in order}
+        for future in concurrent.futures.as_completed(futures):
+            repoName = futures[future]
+            try:
+                results[repoName] = future.result()
+            except Exception:
+                logging.exception(f"Failed to verify {repoName}:")
+                failed.append(repoName)
+    # The lock is only taken for the update, backups may run meanwhile
+    with state.State(targetPath, wait=True) as targetState:
+        coverage = targetState.data.setdefault("verified", {})
+        for repoName, archives in results.items():
+            for name, (status, timestamp) in archives.items():
+                coverage.setdefault(repoName, {})[name] = {"status": status, "time": timestamp}
+                if status == "ok":
+                    covered += 1
+                else:
+                    failed.append(f"{repoName}::{name}")
+        # Forget repos that were removed in the meantime
+        for repoName in set(coverage) - set(state.repoNames(targetPath)):
+            del coverage[repoName]
+        targetState.save()
+    share = covered / total if total else 1.0
+    metrics.annotate(verifiedShare=share)
+    logging.warning(
+        f"{covered} of {total} archives below {targetPath} verified within " +
+        f"the last {period} days")
+    if failed:
+        raise ChildProcessError(f"Verification failed for: {', '.join(failed)}")
+    return share
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Verify the archives of the Borg repositories in a directory")
+    parser.add_argument("target", metavar="TARGET",
+                        help="Root directory the repositories reside in")
+    parser.add_argument("-b", "--budget", metavar="MINUTES", type=float, default=60,
+                        help="Time to spend verifying. Defaults to 60")
+    parser.add_argument("-p", "--period", metavar="DAYS", type=float,
+                        default=DEFAULT_PERIOD,
+                        help="Verify every archive at least once in DAYS days. " +
+                        f"Defaults to {DEFAULT_PERIOD}")
+    parser.add_argument("-w", "--workers", metavar="N", type=int, default=2,
+                        help="Number of repositories verified at the same time. " +
+                        "Defaults to 2")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="Enable verbose logging")
+    parser.add_argument("-d", "--debug", action="store_true",
+                        help="Enable debug logging")
+    args = parser.parse_args()
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+    elif args.verbose:
+        logging.basicConfig(level=logging.INFO)
+    if args.budget <= 0 or args.period <= 0 or args.workers <= 0:
+        raise ValueError("Budget, period and workers must be greater than 0")
+    verifyTarget(args.target, args.budget * 60, args.period, args.workers)
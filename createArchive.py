@@ -3,13 +3,26 @@
 import argparse
 import logging
 
+import json
 import os
-import subprocess
 
 import util
+import util.metrics as metrics
+import util.runner as runner
 
 
-def createArchive(repoPath, name: str, sourcePath):
+# If `paths` is given only those paths (relative to sourcePath) are archived
+# instead of the whole tree. `roots` archives several trees (relative to
+# sourcePath) each on a filesystem of its own, like the snapshots of a
+# group mounted side by side. Returns the `archive` section of borg's
+# `--stats --json` output. `cacheDir` overrides borg's cache directory.
+# `excludeFile` holds borg exclude patterns, `excludeCaches` leaves out
+# directories tagged with a CACHEDIR.TAG and `expectedBytes`, if known,
+# adds a percentage and ETA to the progress.
+def createArchive(repoPath, name: str, sourcePath, filesCache: str = None, paths=None,
+                  compression: str = None, chunkerParams: str = None, cacheDir: str = None,
+                  roots=None, excludeFile: str = None, excludeCaches: bool = False,
+                  expectedBytes: int = None):
     repoPath = os.path.abspath(repoPath)
     logging.debug(f"Validating archive name: {name}")
     if "checkpoint" in name:
@@ -33,17 +46,49 @@ def createArchive(repoPath, name: str, sourcePath):
         raise PermissionError(f"User lacks required permissions: {sourcePath}")
     logging.info(f"Creating Borg archive {repoPath}::{name}")
     os.environ["BORG_UNKNOWN_UNENCRYPTED_REPO_ACCESS_IS_OK"] = "yes"
-    res = subprocess.run(["borg", "create",
-                          "--one-file-system",
-                          # The default of 30 minutes seems like an eternity to me
-                          "--checkpoint-interval", "600",  # 600 seconds = 10 minutes
-                          f"{repoPath}::{name}", "."], text=True, capture_output=True, cwd=str(sourcePath))
+    _args = ["--one-file-system",
+             # The default of 30 minutes seems like an eternity to me
+             "--checkpoint-interval", "600",  # 600 seconds = 10 minutes
+             # A background prune or compact may still hold the repo
+             "--lock-wait", str(runner.LOCK_WAIT),
+             "--stats", "--json"]
+    if filesCache:
+        _args += ["--files-cache", filesCache]
+    if compression:
+        _args += ["--compression", compression]
+    if chunkerParams:
+        _args += ["--chunker-params", chunkerParams]
+    if excludeFile:
+        _args += ["--exclude-from", excludeFile]
+    if excludeCaches:
+        _args.append("--exclude-caches")
+    if paths is not None and roots:
+        raise ValueError("Paths and roots are mutually exclusive")
+    if paths is not None:
+        _args += ["--paths-from-stdin", f"{repoPath}::{name}"]
+    else:
+        # --one-file-system stays on the filesystem of each root separately
+        _args += [f"{repoPath}::{name}", *(roots or ["."])]
+    with metrics.phase("borg_create"):
+        res = runner.runBorg("create", _args, cwd=str(sourcePath), progress=True,
+                             input=paths,
+                             env={"BORG_CACHE_DIR": cacheDir} if cacheDir else None,
+                             expectedBytes=expectedBytes)
+    if res.returncode == 2:
+        raise ChildProcessError(res.errorText())
+    try:
+        archive = json.loads(res.stdout)["archive"]
+    except (ValueError, KeyError):
+        logging.warning("Borg did not report archive statistics")
+        archive = {}
+    metrics.recordArchive(archive)
+    # Placeholders like {now} are expanded in the reported name
+    name = archive.get("name", name)
     if res.returncode == 1:
-        logging.warning(res.stderr)
-    elif res.returncode == 2:
-        raise ChildProcessError(res.stderr)
+        logging.warning(f"Archive created with warnings: {repoPath}::{name}")
     else:
         logging.warning(f"Archive created: {repoPath}::{name}")
+    return archive
 
 
 if __name__ == "__main__":
@@ -53,6 +98,19 @@ if __name__ == "__main__":
                         help="Archive URI in format path::name")
     parser.add_argument("source", metavar="SRC",
                         help="Source directory to backup")
+    parser.add_argument("roots", metavar="ROOT", nargs="*",
+                        help="Only archive these directories below SRC, each on " +
+                        "its own filesystem. Defaults to SRC as a whole")
+    parser.add_argument("--files-cache", metavar="MODE",
+                        help="Borg files cache mode, e.g. `ctime,size,inode`")
+    parser.add_argument("-C", "--compression", metavar="SPEC",
+                        help="Borg compression spec, e.g. `zstd,3`")
+    parser.add_argument("--chunker-params", metavar="PARAMS",
+                        help="Borg chunker parameters, e.g. `buzhash,19,23,21,4095`")
+    parser.add_argument("--exclude-from", metavar="FILE",
+                        help="Read borg exclude patterns from FILE")
+    parser.add_argument("--exclude-caches", action="store_true",
+                        help="Leave out directories tagged with a CACHEDIR.TAG")
     parser.add_argument("-v", "--verbose", action="store_true",
                         help="Enable verbose logging")
     parser.add_argument("-d", "--debug", action="store_true",
@@ -67,4 +125,7 @@ if __name__ == "__main__":
     except:
         raise ValueError(f"Invalid archive URI: {args.archive}")
     sourcePath = args.source
-    createArchive(archivePath, name, sourcePath)
+    createArchive(archivePath, name, sourcePath, args.files_cache,
+                  compression=args.compression, chunkerParams=args.chunker_params,
+                  roots=args.roots, excludeFile=args.exclude_from,
+                  excludeCaches=args.exclude_caches)
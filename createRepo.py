@@ -4,12 +4,14 @@ import argparse
 import logging
 
 import os
-import subprocess
 
 import util
+import util.metrics as metrics
+import util.runner as runner
 
 
-def createRepo(path):
+# `cacheDir` overrides borg's cache directory
+def createRepo(path, cacheDir: str = None):
     path = os.path.abspath(path)
     logging.debug(f"Validating the given path: {path}")
     if not util.exists(path):
@@ -29,12 +31,13 @@ def createRepo(path):
         See https://github.com/borgbackup/borg/issues/6916 and
         https://github.com/borgbackup/borg/issues/4042
     """
-    res = subprocess.run(["borg", "init", "--encryption",
-                         "none", str(path)], text=True, capture_output=True)
+    with metrics.phase("borg_init"):
+        res = runner.runBorg("init", ["--encryption", "none", str(path)],
+                             env={"BORG_CACHE_DIR": cacheDir} if cacheDir else None)
     if res.returncode == 1:
-        logging.warning(res.stderr)
+        logging.warning(res.errorText())
     elif res.returncode == 2:
-        raise ChildProcessError(res.stderr)
+        raise ChildProcessError(res.errorText())
     else:
         logging.warning(f"Borg repo initialized: {path}")
 
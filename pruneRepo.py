@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+
+import util
+import util.cache as cache
+import util.metrics as metrics
+import util.runner as runner
+import util.state as state
+
+# Periods borg prune keeps archives for, as in `--keep-<period>`
+KEEP_PERIODS = ("hourly", "daily", "weekly", "monthly", "yearly")
+# Prefix old repos are renamed to before they are deleted
+TRASH_PREFIX = ".bkmgr-trash-"
+# Log of the detached worker, next to the repos in TARGET
+LOG_FILE = "prune.log"
+# Suffix of archives holding only the files changed since the archive
+# before them (see --btrfs-find-new), they cannot be restored without it
+CHANGED_SUFFIX = "-changed"
+# What `borg prune --dry-run --list` logs for every archive it would delete
+_WOULD_PRUNE = re.compile(r"^Would prune:\s+(\S+)")
+
+
+# Names of the archives in a repo matching `globArchives`, oldest first
+def listArchives(repoPath: str, globArchives: str = None, env: dict = None) -> list:
+    _args = ["--json", "--lock-wait", str(runner.LOCK_WAIT)]
+    if globArchives:
+        _args += ["--glob-archives", globArchives]
+    with metrics.phase("borg_list"):
+        res = runner.runBorg("list", _args + [repoPath], env=env)
+    if res.returncode == 2:
+        raise ChildProcessError(res.errorText())
+    archives = json.loads(res.stdout).get("archives", [])
+    return [archive["name"] for archive in sorted(
+        archives, key=lambda archive: archive.get("start", archive.get("time", "")))]
+
+
+# Archives that kept ones cannot be restored without: a -changed archive
+# needs every archive before it back to and including the last full one.
+# `names` are oldest first.
+def dependencies(names: list, kept: set) -> set:
+    needed = set()
+    for index, name in enumerate(names):
+        if name not in kept or not name.endswith(CHANGED_SUFFIX):
+            continue
+        for previous in reversed(names[:index]):
+            needed.add(previous)
+            if not previous.endswith(CHANGED_SUFFIX):
+                break
+    return needed
+
+
+# Deletes the archives of a repo that are not kept by the `keep` retention
+# ({period: count}, see KEEP_PERIODS) and frees their space with
+# `borg compact`. With `globArchives` only the matching archives are
+# considered, which keeps sources sharing a repo apart. Borg decides what
+# the retention keeps in a dry run, archives kept ones depend on are then
+# spared from the deletion.
+def pruneRepo(repoPath, keep: dict, cacheDir: str = None, globArchives: str = None):
+    repoPath = os.path.abspath(repoPath)
+    logging.debug(f"Validating the given path: {repoPath}")
+    if not util.exists(repoPath):
+        raise FileNotFoundError(f"Path does not exist: {repoPath}")
+    if not util.writeable(repoPath):
+        raise PermissionError(f"User lacks required permissions: {repoPath}")
+    os.environ["BORG_UNKNOWN_UNENCRYPTED_REPO_ACCESS_IS_OK"] = "yes"
+    env = {"BORG_CACHE_DIR": cacheDir} if cacheDir else None
+    _args = ["--lock-wait", str(runner.LOCK_WAIT)]
+    if globArchives:
+        _args += ["--glob-archives", globArchives]
+    policy = []
+    for period, count in keep.items():
+        if count:
+            policy += [f"--keep-{period}", str(count)]
+    if policy:
+        logging.info(f"Pruning Borg repo: {repoPath}")
+        names = listArchives(repoPath, globArchives, env)
+        pruned = set()
+
+        def onMessage(msg: dict):
+            match = _WOULD_PRUNE.match(msg.get("message", ""))
+            if match:
+                pruned.add(match.group(1))
+
+        with metrics.phase("borg_prune"):
+            res = runner.runBorg("prune", ["--dry-run", "--list"] + _args + policy +
+                                 [repoPath], env=env, onMessage=onMessage)
+        if res.returncode == 2:
+            raise ChildProcessError(res.errorText())
+        spared = pruned & dependencies(names, set(names) - pruned)
+        if spared:
+            logging.warning(
+                f"Keeping {len(spared)} archives that kept -changed archives depend on")
+        delete = [name for name in names if name in pruned - spared]
+        if delete:
+            with metrics.phase("borg_delete"):
+                res = runner.runBorg(
+                    "delete", ["--lock-wait", str(runner.LOCK_WAIT), repoPath] + delete,
+                    env=env)
+            if res.returncode == 2:
+                raise ChildProcessError(res.errorText())
+            logging.info(f"Deleted {len(delete)} archives from {repoPath}")
+    logging.info(f"Compacting Borg repo: {repoPath}")
+    with metrics.phase("borg_compact"):
+        res = runner.runBorg(
+            "compact", ["--lock-wait", str(runner.LOCK_WAIT), repoPath], env=env)
+    if res.returncode == 2:
+        raise ChildProcessError(res.errorText())
+    logging.warning(f"Borg repo pruned and compacted: {repoPath}")
+
+
+# Deletes all but the `keepRepos` newest repos in TARGET, and their caches
+# below `cacheRoot`. The current repo is always kept. The lock on TARGET is
+# waited for, but only held to rename the old repos out of the way, so that
+# backups starting meanwhile are not held up by the deletion. Repos renamed
+# by an earlier worker that did not get to delete them go as well.
+def removeOldRepos(targetPath: str, keepRepos: int, cacheRoot: str = None):
+    if keepRepos < 1:
+        raise ValueError("At least one repo must be kept")
+    with state.State(targetPath, wait=True) as targetState:
+        names = state.repoNames(targetPath)
+        for name in names[:-keepRepos]:
+            if name == targetState.currentRepo:
+                continue
+            os.rename(os.path.join(targetPath, name),
+                      os.path.join(targetPath, TRASH_PREFIX + name))
+    for entry in sorted(os.listdir(targetPath)):
+        if not entry.startswith(TRASH_PREFIX):
+            continue
+        name = entry[len(TRASH_PREFIX):]
+        logging.warning(f"Removing old Borg repo: {os.path.join(targetPath, name)}")
+        with metrics.phase("remove_repo"):
+            shutil.rmtree(os.path.join(targetPath, entry))
+        if cacheRoot:
+            shutil.rmtree(cache.cacheDir(cacheRoot, targetPath, name),
+                          ignore_errors=True)
+
+
+# Starts this script as a detached worker at the lowest CPU and IO priority
+# and returns right away. Its output goes to TARGET/prune.log.
+def spawn(targetPath: str, repoName: str, keep: dict, keepRepos: int = None,
+          cacheRoot: str = None, verbose: bool = False,
+          globArchives: str = None) -> subprocess.Popen:
+    command = ["nice", "-n", "19"]
+    if shutil.which("ionice"):
+        command += ["ionice", "-c", "3"]
+    command += [sys.executable, os.path.abspath(__file__),
+                os.path.abspath(targetPath), "--repo", repoName]
+    for period, count in keep.items():
+        if count:
+            command += [f"--keep-{period}", str(count)]
+    if keepRepos:
+        command += ["--keep-repos", str(keepRepos)]
+    if cacheRoot:
+        command += ["--cache-root", os.path.abspath(cacheRoot)]
+    if globArchives:
+        command += ["--glob-archives", globArchives]
+    if verbose:
+        command.append("--verbose")
+    logPath = os.path.join(targetPath, LOG_FILE)
+    with open(logPath, "a") as log:
+        proc = subprocess.Popen(
+            command, stdin=subprocess.DEVNULL, stdout=log, stderr=log,
+            start_new_session=True)
+    logging.info(f"Pruning in the background (pid {proc.pid}), see {logPath}")
+    return proc
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Prune and compact a Borg repository and remove old repositories")
+    parser.add_argument("target", metavar="TARGET",
+                        help="Root directory the repositories reside in")
+    parser.add_argument("--repo", metavar="NAME",
+                        help="Repository below TARGET to prune. " +
+                        "Defaults to the current one")
+    for period in KEEP_PERIODS:
+        parser.add_argument(f"--keep-{period}", metavar="N", type=int,
+                            help=f"Number of {period} archives to keep")
+    parser.add_argument("--glob-archives", metavar="GLOB",
+                        help="Only prune archives matching GLOB, " +
+                        "e.g. the archives of one source")
+    parser.add_argument("--keep-repos", metavar="N", type=int,
+                        help="Remove all but the N newest repositories")
+    parser.add_argument("--cache-root", metavar="DIR",
+                        help="Root of the per repo Borg caches")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="Enable verbose logging")
+    parser.add_argument("-d", "--debug", action="store_true",
+                        help="Enable debug logging")
+    args = parser.parse_args()
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(message)s")
+    if args.debug:
+        logging.root.setLevel(logging.DEBUG)
+    elif args.verbose:
+        logging.root.setLevel(logging.INFO)
+    keep = {period: getattr(args, f"keep_{period}") for period in KEEP_PERIODS}
+    repoName = args.repo or state.State(args.target).currentRepo
+    runMetrics = metrics.start({"target": os.path.abspath(args.target)})
+    try:
+        with runMetrics.phase("total"):
+            if not repoName:
+                raise FileNotFoundError(f"There is no repo in {args.target} yet")
+            cacheDir = None
+            if args.cache_root:
+                cacheDir = cache.cacheDir(args.cache_root, args.target, repoName)
+            pruneRepo(os.path.join(args.target, repoName), keep, cacheDir,
+                      args.glob_archives)
+            if args.keep_repos:
+                removeOldRepos(args.target, args.keep_repos, args.cache_root)
+    except BaseException:
+        runMetrics.finish("failed")
+        logging.exception("Pruning failed:")
+        exit(1)
+    else:
+        runMetrics.finish("success")
+    finally:
+        record = runMetrics.record()
+        state.State(args.target).recordRun({
+            "action": "prune",
+            "repo": repoName,
+            "started": record["started"],
+            "duration": record["duration"],
+            "status": record["status"],
+            "phases": record["phases"],
+        })
@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+
+import collections
+import concurrent.futures
+import contextvars
+import datetime
+import heapq
+import json
+import os
+import tempfile
+import threading
+import time
+
+import util
+import util.metrics as metrics
+import util.runner as runner
+import util.state as state
+import pruneRepo
+
+# Kept in the destination while a restore is in progress, so that running
+# it again only extracts the partitions that did not finish
+RESUME_FILE = ".bkmgr-restore.json"
+# Directories deeper than this are never split up between partitions
+_MAX_DEPTH = 6
+# Minimal interval between two progress lines written to the log (seconds)
+_PROGRESS_INTERVAL = 10
+_MODE_BITS = ((0o400, "r"), (0o200, "w"), (0o100, "x"),
+              (0o040, "r"), (0o020, "w"), (0o010, "x"),
+              (0o004, "r"), (0o002, "w"), (0o001, "x"))
+
+
+# Permission bits of an `ls -l` style mode like `drwxr-sr-t`
+def _parseMode(text: str) -> int:
+    mode = 0
+    for (bit, flag), char in zip(_MODE_BITS, text[1:10]):
+        # s and t stand for an execute bit plus setuid/setgid/sticky
+        if char == flag or (flag == "x" and char in "st"):
+            mode |= bit
+    if text[3:4] in ("s", "S"):
+        mode |= 0o4000
+    if text[6:7] in ("s", "S"):
+        mode |= 0o2000
+    if text[9:10] in ("t", "T"):
+        mode |= 0o1000
+    return mode
+
+
+# Sizes of an archive summed up per directory (down to _MAX_DEPTH) and per
+# top level item, built from `borg list --json-lines` one line at a time
+class Listing:
+    def __init__(self) -> None:
+        self.sizes = collections.Counter()
+        # Subdirectories of every directory
+        self.children = collections.defaultdict(set)
+        # Owner, mode and mtime of the directories
+        self.directories = {}
+        self.total = 0
+        self.items = 0
+
+    def add(self, line: str):
+        try:
+            item = json.loads(line)
+        except ValueError:
+            logging.debug(f"Skipping unexpected listing line: {line}")
+            return
+        parts = item.get("path", "").strip("/").split("/")
+        if not parts[0]:
+            return
+        size = item.get("size") or 0
+        self.items += 1
+        self.total += size
+        isDirectory = item.get("type") == "d"
+        # Every prefix but the item itself is a directory
+        depth = min(len(parts) if isDirectory else len(parts) - 1, _MAX_DEPTH)
+        for i in range(1, depth + 1):
+            path = "/".join(parts[:i])
+            self.sizes[path] += size
+            if i > 1:
+                self.children["/".join(parts[:i - 1])].add(path)
+        if len(parts) == 1 and not isDirectory:
+            self.sizes[parts[0]] += size
+        if isDirectory and len(parts) <= _MAX_DEPTH:
+            self.directories["/".join(parts)] = {
+                "mode": item.get("mode", ""),
+                "uid": item.get("uid"),
+                "gid": item.get("gid"),
+                "mtime": item.get("mtime"),
+            }
+
+
+# Reads the listing of an archive without keeping it in memory
+def listArchive(repoPath: str, name: str) -> Listing:
+    listing = Listing()
+    logging.info(f"Listing {repoPath}::{name}")
+    with metrics.phase("borg_list"):
+        res = runner.runBorg(
+            "list", ["--json-lines", f"{repoPath}::{name}"], onLine=listing.add)
+    if res.returncode == 2:
+        raise ChildProcessError(res.errorText())
+    logging.info(
+        f"{listing.items} items, {runner.formatBytes(listing.total)} in {repoPath}::{name}")
+    return listing
+
+
+# Splits the archive into `count` partitions of about the same size. Top
+# level items are the units that get distributed, except that directories
+# larger than a partition are replaced by their subdirectories, plus the
+# files directly in them, as long as that helps. Every partition is a list
+# of borg patterns, deepest first, so that a directory left to another
+# partition is excluded while a subdirectory of it can still be included.
+# Returns the partitions and the directories that were split up.
+def partition(listing: Listing, count: int) -> tuple:
+    share = listing.total / count
+    pending = [(-size, path, ()) for path, size in listing.sizes.items()
+               if "/" not in path]
+    heapq.heapify(pending)
+    units = []
+    split = set()
+    while pending:
+        size, path, excludes = heapq.heappop(pending)
+        children = listing.children.get(path)
+        # Remainders (units with excludes) hold only files, they stay whole
+        if -size <= share or excludes or not children:
+            units.append((-size, path, excludes))
+            continue
+        split.add(path)
+        remainder = -size
+        for child in children:
+            heapq.heappush(pending, (-listing.sizes[child], child, ()))
+            remainder -= listing.sizes[child]
+        heapq.heappush(pending, (-remainder, path, tuple(sorted(children))))
+    # Largest first onto the emptiest partition
+    bins = [(0, i, []) for i in range(count)]
+    for size, path, excludes in sorted(units, reverse=True):
+        total, i, members = heapq.heappop(bins)
+        members.append((path, excludes))
+        heapq.heappush(bins, (total + size, i, members))
+    partitions = []
+    for total, _, members in sorted(bins, key=lambda item: item[1]):
+        if not members:
+            continue
+        paths = {path for path, _ in members}
+        patterns = [("+", path) for path in paths]
+        patterns += [("-", path) for _, excludes in members for path in excludes
+                     if path not in paths]
+        patterns.sort(key=lambda pattern: (-pattern[1].count("/"), pattern[1]))
+        partitions.append({
+            "paths": sorted(paths),
+            "patterns": [f"{sign} pp:{path}" for sign, path in patterns],
+            "size": total,
+            "done": False,
+        })
+    return partitions, sorted(split)
+
+
+# Sums up the progress of all partitions and logs it now and then
+class Progress:
+    def __init__(self, total: int, done: int = 0) -> None:
+        self.__total = total
+        self.__done = done
+        self.__current = {}
+        self.__lock = threading.Lock()
+        self.__started = time.monotonic()
+        self.__lastLogged = 0.0
+
+    def update(self, index: int, current: int):
+        with self.__lock:
+            self.__current[index] = current
+            now = time.monotonic()
+            if now - self.__lastLogged < _PROGRESS_INTERVAL:
+                return
+            self.__lastLogged = now
+            restored = self.__done + sum(self.__current.values())
+        elapsed = now - self.__started
+        rate = restored / elapsed if elapsed else 0
+        percent = 100 * restored / self.__total if self.__total else 100
+        logging.info(f"{runner.formatBytes(restored)} of {runner.formatBytes(self.__total)} " +
+                     f"restored ({percent:.1f}%, {runner.formatBytes(rate)}/s)")
+
+    def finish(self, index: int, size: int):
+        with self.__lock:
+            self.__current.pop(index, None)
+            self.__done += size
+
+
+def _extract(repoPath: str, name: str, destination: str, part: dict,
+             index: int, progress: Progress):
+    with tempfile.NamedTemporaryFile("w", prefix="bkmgr-patterns-", suffix=".lst") as f:
+        f.write("\n".join(part["patterns"]) + "\n")
+        f.flush()
+        with metrics.phase("borg_extract"):
+            res = runner.runBorg(
+                "extract", ["--patterns-from", f.name, f"{repoPath}::{name}",
+                            *part["paths"]],
+                cwd=destination, progress=True,
+                onPercent=lambda current, total: progress.update(index, current))
+    if res.returncode == 2:
+        raise ChildProcessError(res.errorText())
+    if res.returncode == 1:
+        logging.warning(f"Partition {index} restored with warnings: {res.errorText()}")
+
+
+# Directories that were split between partitions were created by whichever
+# borg got there first and changed by the others, set them up properly now
+def restoreDirectories(destination: str, directories: dict):
+    for path in sorted(directories, key=lambda path: -path.count("/")):
+        meta = directories[path]
+        fullPath = os.path.join(destination, path)
+        os.makedirs(fullPath, exist_ok=True)
+        try:
+            os.chown(fullPath, meta["uid"], meta["gid"])
+        except (PermissionError, TypeError):
+            logging.debug(f"Cannot restore the owner of {fullPath}")
+        if meta["mode"]:
+            os.chmod(fullPath, _parseMode(meta["mode"]))
+        if meta["mtime"]:
+            mtime = datetime.datetime.fromisoformat(meta["mtime"]).timestamp()
+            os.utime(fullPath, (mtime, mtime))
+
+
+# Archives a -changed archive is restored on top of, oldest first. The
+# chain is looked for among the archives of the same source only.
+def changedChain(repoPath: str, name: str) -> list:
+    prefix = name.split("-", 1)[0]
+    names = pruneRepo.listArchives(repoPath, f"{prefix}-*")
+    if name not in names:
+        raise FileNotFoundError(f"No archive {name} in {repoPath}")
+    needed = pruneRepo.dependencies(names, {name})
+    return [previous for previous in names if previous in needed]
+
+
+# Extracts an archive into `destination` with `workers` borg processes in
+# parallel, each restoring a partition of about the same size. The plan is
+# kept in the destination until everything is restored, a failed restore
+# picks up the partitions that did not finish when run again. A -changed
+# archive is refused unless `partial` is set.
+def restoreArchive(repoPath, name: str, destination, workers: int = None,
+                   partitions: int = None, partial: bool = False):
+    repoPath = os.path.abspath(repoPath)
+    destination = os.path.abspath(destination)
+    workers = workers or os.cpu_count()
+    logging.debug(f"Validating the given path: {repoPath}")
+    if not util.exists(repoPath):
+        raise FileNotFoundError(f"Path does not exist: {repoPath}")
+    logging.debug(f"Validating destination path: {destination}")
+    os.makedirs(destination, exist_ok=True)
+    if not util.writeable(destination):
+        raise PermissionError(f"User lacks required permissions: {destination}")
+    os.environ["BORG_UNKNOWN_UNENCRYPTED_REPO_ACCESS_IS_OK"] = "yes"
+    resumePath = os.path.join(destination, RESUME_FILE)
+    plan = None
+    try:
+        with open(resumePath, "r") as f:
+            plan = json.load(f)
+    except FileNotFoundError:
+        pass
+    if plan is not None and plan.get("archive") == f"{repoPath}::{name}":
+        logging.warning(f"Resuming the restore recorded in {resumePath}")
+    else:
+        if plan is not None or not util.emptyDir(destination):
+            raise FileExistsError(
+                f"Directory is not empty: {destination} Refusing to proceed")
+        if name.endswith(pruneRepo.CHANGED_SUFFIX):
+            chain = changedChain(repoPath, name)
+            if not partial:
+                raise ValueError(
+                    f"{name} only holds the files changed since the archive before it, " +
+                    f"the full tree needs {', '.join(chain)} extracted first in this " +
+                    "order. Pass --partial to restore it alone")
+            logging.warning(f"Restoring only the changed files, {name} depends on " +
+                            ", ".join(chain))
+        listing = listArchive(repoPath, name)
+        parts, split = partition(listing, partitions or workers)
+        plan = {
+            "archive": f"{repoPath}::{name}",
+            "total": listing.total,
+            "partitions": parts,
+            "directories": {path: listing.directories[path]
+                            for path in split if path in listing.directories},
+        }
+        state.atomicWriteJSON(resumePath, plan)
+    pending = [i for i, part in enumerate(plan["partitions"]) if not part["done"]]
+    progress = Progress(plan["total"], sum(
+        part["size"] for part in plan["partitions"] if part["done"]))
+    planLock = threading.Lock()
+    failed = []
+    logging.info(f"Restoring {len(pending)} partitions with {workers} workers")
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        futures = {
+            pool.submit(contextvars.copy_context().run, _extract, repoPath, name,
+                        destination, plan["partitions"][i], i, progress): i
+            for i in pending}
+        for future in concurrent.futures.as_completed(futures):
+            i = futures[future]
+            part = plan["partitions"][i]
+            try:
+                future.result()
+            except Exception:
+                logging.exception(f"Partition {i} ({', '.join(part['paths'][:3])}...) failed:")
+                failed.append(i)
+                continue
+            progress.finish(i, part["size"])
+            with planLock:
+                part["done"] = True
+                state.atomicWriteJSON(resumePath, plan)
+            logging.info(f"Partition {i} restored")
+    if failed:
+        raise ChildProcessError(
+            f"{len(failed)} of {len(plan['partitions'])} partitions failed, " +
+            "run the restore again to retry them")
+    restoreDirectories(destination, plan["directories"])
+    os.unlink(resumePath)
+    logging.warning(f"Archive restored: {repoPath}::{name} to {destination}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Restore a Borg archive with several borg processes in parallel")
+    parser.add_argument("archive", metavar="ARCHIVE",
+                        help="Archive URI in format path::name")
+    parser.add_argument("destination", metavar="DEST",
+                        help="Empty directory to restore into, or the directory " +
+                        "of an unfinished restore to resume")
+    parser.add_argument("-w", "--workers", metavar="N", type=int, default=os.cpu_count(),
+                        help="Number of borg processes extracting at the same time. " +
+                        "Defaults to the number of CPUs")
+    parser.add_argument("-p", "--partitions", metavar="N", type=int,
+                        help="Number of parts the archive is split into. More parts " +
+                        "than workers make a retry cheaper. Defaults to --workers")
+    parser.add_argument("--partial", action="store_true",
+                        help="Restore a -changed archive, which holds only the files " +
+                        "changed since the archive before it, on its own")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="Enable verbose logging")
+    parser.add_argument("-d", "--debug", action="store_true",
+                        help="Enable debug logging")
+    args = parser.parse_args()
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+    elif args.verbose:
+        logging.basicConfig(level=logging.INFO)
+    if args.workers <= 0 or (args.partitions is not None and args.partitions <= 0):
+        raise ValueError("Workers and partitions must be greater than 0")
+    try:
+        archivePath, name = args.archive.split("::")
+    except:
+        raise ValueError(f"Invalid archive URI: {args.archive}")
+    restoreArchive(archivePath, name, args.destination, args.workers, args.partitions,
+                   args.partial)
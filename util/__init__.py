@@ -1,4 +1,5 @@
 import os
+import re
 
 # Exception safe
 
@@ -32,3 +33,10 @@ def fileWriteable(path) -> bool:
 
 def emptyDir(path) -> bool:
     return not os.listdir(path)
+
+# File name friendly, stable name of a path
+
+
+def slug(path) -> str:
+    path = os.path.abspath(path)
+    return re.sub(r"[^a-zA-Z0-9]+", "_", path).strip("_") or "root"
@@ -0,0 +1,84 @@
+import logging
+
+import os
+import shutil
+
+import util
+import util.metrics as metrics
+import util.runner as runner
+
+
+# Borg cache directory of a repo: one per TARGET and repo directory name
+def cacheDir(cacheRoot: str, targetPath: str, repoName: str) -> str:
+    return os.path.join(cacheRoot, util.slug(targetPath), repoName)
+
+
+# Environment for borg to use the managed cache directory. The directory is
+# touched as well, its mtime is what eviction goes by.
+def borgEnv(cachePath: str) -> dict:
+    os.makedirs(cachePath, exist_ok=True)
+    os.utime(cachePath)
+    return {"BORG_CACHE_DIR": cachePath}
+
+
+def _size(path: str) -> int:
+    total = 0
+    for dirPath, _, fileNames in os.walk(path):
+        for name in fileNames:
+            try:
+                total += os.lstat(os.path.join(dirPath, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+# Removes the least recently used cache directories below `cacheRoot` until
+# all of them together fit in `budget` bytes. Directories in `keep` and the
+# cache of the newest repo of every TARGET, which is its current one, are
+# never removed, so jobs sharing the root do not evict each other's caches.
+def evict(cacheRoot: str, budget: int, keep=()):
+    keep = {os.path.abspath(path) for path in keep}
+    caches = []
+    for target in os.listdir(cacheRoot):
+        targetPath = os.path.join(cacheRoot, target)
+        if not os.path.isdir(targetPath):
+            continue
+        repos = [repo for repo in os.listdir(targetPath)
+                 if os.path.isdir(os.path.join(targetPath, repo))]
+        # Repo names are timestamps, the newest sorts last
+        if repos:
+            keep.add(os.path.abspath(os.path.join(targetPath, max(repos))))
+        for repo in repos:
+            path = os.path.join(targetPath, repo)
+            caches.append((os.stat(path).st_mtime, path, _size(path)))
+    total = sum(size for _, _, size in caches)
+    for _, path, size in sorted(caches):
+        if total <= budget:
+            break
+        if os.path.abspath(path) in keep:
+            continue
+        logging.info(f"Evicting borg cache {path} ({runner.formatBytes(size)})")
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+        # Drop the TARGET level directory once it is empty
+        try:
+            os.rmdir(os.path.dirname(path))
+        except OSError:
+            pass
+    if total > budget:
+        logging.warning(
+            f"Borg caches below {cacheRoot} take {runner.formatBytes(total)}, " +
+            "more than the budget, but all of them are in use")
+
+
+# Builds (or brings up to date) the cache of a repo, so that the next backup
+# does not have to resync it first
+def prewarm(repoPath: str, cachePath: str):
+    logging.info(f"Pre-warming borg cache {cachePath} for {repoPath}")
+    os.environ["BORG_UNKNOWN_UNENCRYPTED_REPO_ACCESS_IS_OK"] = "yes"
+    with metrics.phase("borg_prewarm"):
+        # Opening the cache, which `borg info` does, synchronizes it
+        res = runner.runBorg("info", ["--json", repoPath], env=borgEnv(cachePath))
+    if res.returncode == 2:
+        raise ChildProcessError(res.errorText())
+    logging.warning(f"Borg cache for {repoPath} is warm")
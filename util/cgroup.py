@@ -0,0 +1,202 @@
+import logging
+
+import contextvars
+import os
+import threading
+
+_CGROUP_ROOT = "/sys/fs/cgroup"
+_SLICE = "bkmgr.slice"
+_PRESSURE = "/proc/pressure"
+# Controllers the throttle needs, in cgroup.subtree_control syntax
+_CONTROLLERS = ("io", "cpu")
+# Never throttle IO below this many bytes per second, borg has to progress
+_MIN_BPS = 1024 * 1024
+# cpu.max period in microseconds, and never less than a tenth of a CPU
+_CPU_PERIOD = 100000
+_MIN_CPU_QUOTA = _CPU_PERIOD // 10
+
+# Throttle the processes started in the current context are put into
+_current = contextvars.ContextVar("bkmgrThrottle", default=None)
+
+
+def _read(path: str) -> str:
+    with open(path, "r") as f:
+        return f.read()
+
+
+def _write(path: str, value: str):
+    with open(path, "w") as f:
+        f.write(value)
+
+
+# Whether this is a cgroup v2 host with the IO and CPU controllers
+def available() -> bool:
+    try:
+        controllers = _read(os.path.join(_CGROUP_ROOT, "cgroup.controllers")).split()
+    except OSError:
+        return False
+    return all(controller in controllers for controller in _CONTROLLERS) and \
+        os.path.exists(os.path.join(_PRESSURE, "io"))
+
+
+# `some avg10` of /proc/pressure/<resource>: the share of the last 10 seconds
+# at least one task on the host was stalled waiting for it, in percent.
+# With `cgroupPath` the same figure for the tasks in that cgroup only.
+def pressure(resource: str, cgroupPath: str = None) -> float:
+    if cgroupPath:
+        path = os.path.join(cgroupPath, f"{resource}.pressure")
+    else:
+        path = os.path.join(_PRESSURE, resource)
+    for line in _read(path).splitlines():
+        fields = line.split()
+        if fields and fields[0] == "some":
+            for field in fields[1:]:
+                key, _, value = field.partition("=")
+                if key == "avg10":
+                    return float(value)
+    return 0.0
+
+
+# Moves the process `pid` into the current throttle, if there is one. Called
+# right after the process was started: a `preexec_fn` would do it before the
+# process executes anything, but is not safe while other threads run.
+def attach(pid: int):
+    throttle = _current.get()
+    if throttle is not None:
+        throttle.attach(pid)
+
+
+# Runs everything passed to attach() in a transient cgroup under bkmgr.slice
+# and adapts its limits to the pressure on the host: when other tasks start
+# stalling on IO or CPU the limits are halved, while the host is calm they
+# are relaxed again until borg runs unconstrained. CPU is limited with
+# cpu.max rather than cpu.weight, as weights only count against siblings,
+# which are other bkmgr scopes and not the rest of the host.
+class Throttle:
+    def __init__(self, name: str, pressureHigh: float = 10.0,
+                 pressureLow: float = 2.0, interval: float = 5.0) -> None:
+        if not available():
+            raise FileNotFoundError(
+                "cgroup v2 with io and cpu controllers and PSI is not available")
+        if pressureLow >= pressureHigh:
+            raise ValueError("Low pressure threshold must be below the high one")
+        self.__slicePath = os.path.join(_CGROUP_ROOT, _SLICE)
+        self.path = os.path.join(self.__slicePath, name)
+        self.__pressureHigh = pressureHigh
+        self.__pressureLow = pressureLow
+        self.__interval = interval
+        self.__stop = threading.Event()
+        self.__thread = None
+        self.__token = None
+        # Current io.max limits as {device: [rbps, wbps]}, None is unlimited
+        self.__limits = {}
+        self.__peaks = {}
+        self.__lastStat = None
+        # Current cpu.max quota per period, None is unlimited
+        self.__cpuQuota = None
+        self.__procsFd = None
+
+    def attach(self, pid: int):
+        os.write(self.__procsFd, str(pid).encode())
+
+    def __enter__(self):
+        enable = " ".join(f"+{controller}" for controller in _CONTROLLERS)
+        _write(os.path.join(_CGROUP_ROOT, "cgroup.subtree_control"), enable)
+        os.makedirs(self.__slicePath, exist_ok=True)
+        _write(os.path.join(self.__slicePath, "cgroup.subtree_control"), enable)
+        os.makedirs(self.path, exist_ok=True)
+        self.__procsFd = os.open(os.path.join(self.path, "cgroup.procs"), os.O_WRONLY)
+        _write(os.path.join(self.path, "cpu.max"), f"max {_CPU_PERIOD}")
+        self.__token = _current.set(self)
+        self.__thread = threading.Thread(target=self.__control, daemon=True)
+        self.__thread.start()
+        logging.info(f"Throttling backup processes in {self.path}")
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.__stop.set()
+        self.__thread.join()
+        _current.reset(self.__token)
+        os.close(self.__procsFd)
+        try:
+            os.rmdir(self.path)
+        except OSError as ex:
+            logging.warning(f"Failed to remove cgroup {self.path}: {ex}")
+        return True if exc_type is None else False
+
+    # Bytes read and written per device since the previous call
+    def __rates(self) -> dict:
+        current = {}
+        for line in _read(os.path.join(self.path, "io.stat")).splitlines():
+            fields = line.split()
+            values = dict(field.split("=", 1) for field in fields[1:])
+            current[fields[0]] = (int(values.get("rbytes", 0)), int(values.get("wbytes", 0)))
+        previous, self.__lastStat = self.__lastStat, current
+        if previous is None:
+            return {}
+        return {device: [(now - before) / self.__interval
+                         for now, before in zip(values, previous.get(device, (0, 0)))]
+                for device, values in current.items()}
+
+    def __adjustIO(self, stalled: bool, calm: bool):
+        for device, rates in self.__rates().items():
+            peaks = self.__peaks.setdefault(device, [0.0, 0.0])
+            self.__peaks[device] = [max(peak, rate) for peak, rate in zip(peaks, rates)]
+            limits = self.__limits.get(device)
+            if stalled:
+                # Halve whatever borg currently gets
+                base = limits or rates
+                limits = [max(_MIN_BPS, int(value / 2)) for value in base]
+            elif calm and limits is not None:
+                limits = [int(value * 1.25) for value in limits]
+                # Lift the limit once it no longer holds borg back
+                if all(limit > 2 * peak for limit, peak in zip(limits, self.__peaks[device])):
+                    limits = None
+            else:
+                continue
+            if limits == self.__limits.get(device):
+                continue
+            self.__limits[device] = limits
+            value = "rbps=max wbps=max" if limits is None else \
+                f"rbps={limits[0]} wbps={limits[1]}"
+            try:
+                _write(os.path.join(self.path, "io.max"), f"{device} {value}")
+            except OSError as ex:
+                # Not every device supports throttling
+                logging.debug(f"Cannot limit IO on {device}: {ex}")
+                continue
+            logging.info(f"IO limit on {device} set to {value}")
+
+    def __adjustCPU(self, stalled: bool, calm: bool):
+        quota = self.__cpuQuota
+        if stalled:
+            # Unlimited borg may use every CPU
+            base = quota or (os.cpu_count() or 1) * _CPU_PERIOD
+            quota = max(_MIN_CPU_QUOTA, base // 2)
+        elif calm and quota is not None:
+            quota *= 2
+            if quota >= (os.cpu_count() or 1) * _CPU_PERIOD:
+                quota = None
+        if quota != self.__cpuQuota:
+            self.__cpuQuota = quota
+            value = f"{quota or 'max'} {_CPU_PERIOD}"
+            _write(os.path.join(self.path, "cpu.max"), value)
+            logging.info(f"CPU limit set to {value}")
+
+    # Stalls of everything but borg itself. Borg waiting for the disks
+    # counts towards the host's pressure too, so its own share is taken out
+    # to not throttle it for merely being busy.
+    def __foregroundPressure(self, resource: str) -> float:
+        return max(0.0, pressure(resource) - pressure(resource, self.path))
+
+    def __control(self):
+        while not self.__stop.wait(self.__interval):
+            try:
+                ioPressure = self.__foregroundPressure("io")
+                cpuPressure = self.__foregroundPressure("cpu")
+                self.__adjustIO(ioPressure >= self.__pressureHigh,
+                                ioPressure <= self.__pressureLow)
+                self.__adjustCPU(cpuPressure >= self.__pressureHigh,
+                                 cpuPressure <= self.__pressureLow)
+            except OSError:
+                logging.exception("Failed to adjust backup throttling:")
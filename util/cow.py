@@ -0,0 +1,127 @@
+import logging
+
+import math
+import os
+import subprocess
+import threading
+import time
+
+import util.metrics as metrics
+import util.sysinfo as sysinfo
+
+GIB = 1024 ** 3
+# Sectors in /sys/block/*/stat are always 512 bytes
+_SECTOR = 512
+# Estimates are multiplied by this, a full snapshot is a lost backup
+_SAFETY_FACTOR = 2
+# Assumed backup duration if there is no previous run to go by (seconds)
+DEFAULT_DURATION = 4 * 3600
+
+
+# Total number of sectors written to the device behind `volume` since boot
+def sectorsWritten(volume: str) -> int:
+    device = sysinfo.lookup(lambda idx: idx.blockDevice(volume))
+    with open(os.path.join(device.sysPath, "stat"), "r") as f:
+        # Field 7 is `write sectors`, see Documentation/block/stat.rst
+        return int(f.read().split()[6])
+
+
+# Write rate of `volume` in bytes per second: the higher of the rate seen
+# right now (sampled for `sampleSeconds`) and the average since `previous`,
+# a (sectors, timestamp) pair recorded by an earlier run
+def writeRate(volume: str, previous=None, sampleSeconds: float = 5.0) -> float:
+    started = time.monotonic()
+    first = sectorsWritten(volume)
+    time.sleep(sampleSeconds)
+    last = sectorsWritten(volume)
+    rate = (last - first) * _SECTOR / (time.monotonic() - started)
+    if previous is not None:
+        sectors, timestamp = previous
+        # Counters start over after a reboot
+        if sectors <= last and timestamp < time.time():
+            rate = max(rate, (last - sectors) * _SECTOR / (time.time() - timestamp))
+    return rate
+
+
+# Free space of the volume group `volume` belongs to in whole GiB, None if
+# LVM cannot tell
+def freeSize(volume: str) -> int:
+    device = sysinfo.lookup(lambda idx: idx.blockDevice(volume))
+    res = subprocess.run(
+        ["vgs", "--noheadings", "--units", "b", "--nosuffix", "-o", "vg_free",
+         device.volumeGroup], capture_output=True, text=True)
+    if res.returncode != 0:
+        logging.warning(f"Cannot tell the free space of {device.volumeGroup}: {res.stderr}")
+        return None
+    return int(res.stdout.strip()) // GIB
+
+
+# COW size in GiB needed to snapshot `volume` for `duration` seconds,
+# between `minimum` and `maximum` GiB and no more than its volume group has
+# free, a smaller snapshot is still better than none
+def estimateSize(volume: str, duration: float, previous=None,
+                 minimum: int = 1, maximum: int = None) -> int:
+    with metrics.phase("cow_estimate"):
+        rate = writeRate(volume, previous)
+        free = freeSize(volume)
+    size = math.ceil(rate * duration * _SAFETY_FACTOR / GIB)
+    for limit in (maximum, free):
+        if limit is not None and size > limit:
+            size = limit
+    size = max(minimum, size)
+    logging.info(
+        f"{volume} is written at {rate / 1024 ** 2:.1f}MiB/s, "
+        f"using a {size}GiB snapshot for an expected {duration / 60:.0f} minutes" +
+        (f" ({free}GiB free)" if free is not None else ""))
+    return size
+
+
+# Watches the fill level of a COW snapshot while it exists and grows it by
+# half its size whenever it is `extendAt` percent full, so that it does not
+# overflow (and become invalid) in the middle of a backup
+class CowMonitor:
+    def __init__(self, volumeGroup: str, snapshotName: str,
+                 extendAt: float = 80.0, interval: float = 30.0) -> None:
+        self.__volume = f"{volumeGroup}/{snapshotName}"
+        self.__extendAt = extendAt
+        self.__interval = interval
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def fillPercent(self) -> float:
+        res = subprocess.run(
+            ["lvs", "--noheadings", "--nosuffix", "-o", "data_percent", self.__volume],
+            capture_output=True, text=True)
+        if res.returncode != 0:
+            raise ChildProcessError(res.stderr)
+        return float(res.stdout.strip() or 0)
+
+    def extend(self):
+        res = subprocess.run(
+            ["lvextend", "-l", "+50%LV", self.__volume], capture_output=True, text=True)
+        if res.returncode != 0:
+            raise ChildProcessError(res.stderr)
+        logging.warning(f"Snapshot {self.__volume} extended by half its size")
+
+    def __watch(self):
+        while not self.__stop.wait(self.__interval):
+            try:
+                percent = self.fillPercent()
+                logging.debug(f"Snapshot {self.__volume} is {percent:.1f}% full")
+                if percent >= 100:
+                    logging.error(f"Snapshot {self.__volume} overflowed")
+                    return
+                if percent >= self.__extendAt:
+                    self.extend()
+            except (ChildProcessError, ValueError):
+                logging.exception(f"Failed to watch snapshot {self.__volume}:")
+
+    def __enter__(self):
+        self.__thread = threading.Thread(target=self.__watch, daemon=True)
+        self.__thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.__stop.set()
+        self.__thread.join()
+        return True if exc_type is None else False
@@ -0,0 +1,236 @@
+import logging
+
+import asyncio
+import collections
+import concurrent.futures
+import contextvars
+import json
+import os
+import select
+import signal
+import socket
+import time
+
+import util.jobs as jobs
+import util.metrics as metrics
+import util.sysinfo as sysinfo
+
+DEFAULT_SOCKET = "/run/bkmgr.sock"
+_MOUNTINFO = "/proc/self/mountinfo"
+
+
+# A job the daemon runs over and over, every `interval` seconds
+class ScheduledJob:
+    def __init__(self, job, source: str, sources: list, target: str,
+                 interval: float, lastRun: float = None) -> None:
+        self.job = job
+        self.source = source
+        self.target = target
+        self.interval = interval
+        self.resources = jobs.resourceKeys(sources, target)
+        self.nextRun = lastRun + interval if lastRun else time.time()
+        self.lastStatus = None
+        self.lastFinished = lastRun
+        self.running = False
+        self.started = None
+        # Context the job runs in, its metrics are looked up there
+        self.context = None
+
+    def status(self) -> dict:
+        result = {
+            "source": self.source,
+            "target": self.target,
+            "running": self.running,
+            "started": self.started if self.running else None,
+            "nextRun": None if self.running else self.nextRun,
+            "lastStatus": self.lastStatus,
+            "lastFinished": self.lastFinished,
+        }
+        runMetrics = metrics.currentIn(self.context) if self.running else None
+        if runMetrics is not None:
+            result["phases"] = dict(runMetrics.phases)
+            event = runMetrics.progress
+            if event is not None:
+                result["progress"] = {
+                    "bytesProcessed": event.bytesProcessed,
+                    "deduplicatedBytes": event.deduplicatedBytes,
+                    "files": event.files,
+                    "bytesPerSecond": event.bytesPerSecond,
+                    "percent": event.percent,
+                    "eta": event.eta,
+                    "path": event.path,
+                }
+        return result
+
+
+# Runs the backup jobs of a host from a single long-lived process. An
+# asyncio loop owns the schedule and starts due jobs in a thread pool within
+# the same disk and target limits as runJobs(), so the mount and block
+# device index stays warm between runs and is only rebuilt when the mount
+# table changes. Clients talk JSON lines over a UNIX socket:
+#   {"command": "status"}               -> {"jobs": [...]}
+#   {"command": "run", "source": SRC}   -> {"started": [...]}
+class Daemon:
+    def __init__(self, scheduled: list, jobFn, workers: int,
+                 perSource: int = 1, perTarget: int = 1,
+                 socketPath: str = DEFAULT_SOCKET) -> None:
+        self.scheduled = scheduled
+        self.__jobFn = jobFn
+        self.__workers = workers
+        self.__limits = {"source": perSource, "target": perTarget, "repo": 1}
+        self.__socketPath = socketPath
+        self.__busy = collections.Counter()
+        self.__running = 0
+        self.__pool = None
+        self.__wake = None
+        self.__stopping = False
+
+    # Starts every due job whose resources are free, returns the seconds
+    # until the next job is due, or None to wait for a wake up. Due jobs that
+    # cannot start yet are started once a running job finishes, which wakes
+    # the scheduler up.
+    def __schedule(self) -> float:
+        now = time.time()
+        for job in sorted(self.scheduled, key=lambda job: job.nextRun):
+            if self.__stopping or self.__running >= self.__workers:
+                break
+            if job.running or job.nextRun > now:
+                continue
+            if any(self.__busy[key] >= self.__limits[key[0]] for key in job.resources):
+                continue
+            self.__start(job)
+        if self.__stopping:
+            return None
+        upcoming = [job.nextRun for job in self.scheduled
+                    if not job.running and job.nextRun > now]
+        return min(upcoming) - now if upcoming else None
+
+    def __start(self, job: ScheduledJob):
+        logging.info(f"Starting job {job.source} -> {job.target}")
+        self.__busy.update(job.resources)
+        self.__running += 1
+        job.running = True
+        job.started = time.time()
+        job.context = contextvars.copy_context()
+        future = asyncio.get_running_loop().run_in_executor(
+            self.__pool, job.context.run, self.__jobFn, job.job)
+        future.add_done_callback(lambda future: self.__finished(job, future))
+
+    def __finished(self, job: ScheduledJob, future):
+        self.__busy.subtract(job.resources)
+        self.__running -= 1
+        job.running = False
+        job.lastFinished = time.time()
+        job.nextRun = job.lastFinished + job.interval
+        try:
+            future.result()
+        except Exception:
+            logging.exception(f"Job {job.source} -> {job.target} failed:")
+            job.lastStatus = "failed"
+        else:
+            logging.info(f"Job {job.source} -> {job.target} finished")
+            job.lastStatus = "success"
+        self.__wake.set()
+
+    def __handle(self, request: dict) -> dict:
+        command = request.get("command")
+        if command == "status":
+            return {"jobs": [job.status() for job in self.scheduled]}
+        if command == "run":
+            source = request.get("source")
+            matches = [job for job in self.scheduled
+                       if source is None or job.source == os.path.abspath(source)]
+            if not matches:
+                return {"error": f"No job for {source}"}
+            for job in matches:
+                if not job.running:
+                    job.nextRun = time.time()
+            self.__wake.set()
+            return {"started": [job.source for job in matches]}
+        return {"error": f"Unknown command: {command}"}
+
+    async def __client(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    response = self.__handle(request) if isinstance(request, dict) \
+                        else {"error": "Requests must be JSON objects"}
+                except ValueError as ex:
+                    response = {"error": f"Invalid request: {ex}"}
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    # The kernel flags /proc/self/mountinfo with POLLPRI whenever the mount
+    # table changes, the index is rebuilt then instead of on every job
+    def __watchMounts(self, loop):
+        fd = os.open(_MOUNTINFO, os.O_RDONLY)
+        poller = select.epoll()
+        poller.register(fd, select.EPOLLPRI | select.EPOLLERR)
+
+        def changed():
+            poller.poll(0)
+            # Reading the file to its end acknowledges the change
+            os.lseek(fd, 0, os.SEEK_SET)
+            while os.read(fd, 65536):
+                pass
+            try:
+                sysinfo.index(refresh=True)
+            except OSError:
+                logging.exception("Failed to refresh the mount index:")
+            logging.debug("Mount table changed, index refreshed")
+
+        changed()
+        loop.add_reader(poller.fileno(), changed)
+        return fd, poller
+
+    def __stop(self):
+        logging.warning("Stopping, waiting for running jobs to finish...")
+        self.__stopping = True
+        self.__wake.set()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.__wake = asyncio.Event()
+        self.__pool = concurrent.futures.ThreadPoolExecutor(self.__workers)
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, self.__stop)
+        fd, poller = self.__watchMounts(loop)
+        if os.path.exists(self.__socketPath):
+            os.unlink(self.__socketPath)
+        server = await asyncio.start_unix_server(self.__client, self.__socketPath)
+        os.chmod(self.__socketPath, 0o600)
+        logging.warning(
+            f"Scheduling {len(self.scheduled)} jobs, listening on {self.__socketPath}")
+        try:
+            while not self.__stopping or self.__running:
+                timeout = self.__schedule()
+                self.__wake.clear()
+                try:
+                    await asyncio.wait_for(self.__wake.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            server.close()
+            await server.wait_closed()
+            os.unlink(self.__socketPath)
+            loop.remove_reader(poller.fileno())
+            poller.close()
+            os.close(fd)
+            self.__pool.shutdown()
+
+
+# Sends a request to a running daemon and returns its response
+def request(socketPath: str, message: dict) -> dict:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socketPath)
+        sock.sendall(json.dumps(message).encode() + b"\n")
+        with sock.makefile("r") as f:
+            return json.loads(f.readline())
@@ -1,9 +1,14 @@
 import logging
 
+import concurrent.futures
+import contextvars
 import os
 import subprocess
 import tempfile
 import util
+import util.cgroup as cgroup
+import util.metrics as metrics
+import util.sysinfo as sysinfo
 
 import re
 
@@ -12,44 +17,36 @@ import re
 
 class BTRFSSnap:
     _snapshotNameRegex = re.compile(r'^[a-zA-Z0-9]+$')
+    # Every snapshot is a new subvolume with its own anonymous device
+    # and inode numbers that cannot be relied upon between runs, so borg
+    # should only look at ctime and size
+    filesCache = "ctime,size"
 
     def __init__(self, sourcePath: str, name: str) -> None:
         self.__sourcePath = sourcePath
         self.__name = name
         self.__rootSubvol = None
         # Check if sourcePath is on a btrfs filesystem
-        res = subprocess.run(
-            ["stat", "-f", "-c", "%T", sourcePath], capture_output=True, text=True)
-        if res.returncode != 0:
-            raise ChildProcessError(res.stderr)
-        if res.stdout.strip() != 'btrfs':
+        if sysinfo.fsType(sourcePath) != 'btrfs':
             raise ValueError(f"{sourcePath} is not on a btrfs filesystem")
         # Check if snapshot name is valid
         if not self._snapshotNameRegex.match(name):
             raise ValueError('Invalid snapshot name')
         # Determine root filesystem of sourcePath
-        res = subprocess.run(
-            ["findmnt", "-n", "-o", "SOURCE", "-T", sourcePath], capture_output=True, text=True)
-        if res.returncode != 0:
-            raise ChildProcessError(res.stderr)
-        if "[" in res.stdout:
-            self.__rootDevice = res.stdout.strip().split("[")[0].strip()
-            self.__rootSubvol = res.stdout.strip().split("[")[1].strip("]")
-        else:
-            self.__rootDevice = res.stdout.strip()
-        res = subprocess.run(
-            ["findmnt", "-n", "-o", "TARGET", "-T", sourcePath], capture_output=True, text=True)
-        if res.returncode != 0:
-            raise ChildProcessError(res.stderr)
-        self.__rootFS = res.stdout.strip()
+        mount = sysinfo.lookup(lambda idx: idx.mountOf(sourcePath))
+        self.__rootDevice = mount.source
+        if mount.root != "/":
+            self.__rootSubvol = mount.root
+        self.__rootFS = mount.mountpoint
 
     def __enter__(self):
         logging.debug(
             f"Creating snapshot {self.__name} for {self.__sourcePath}")
-        res = subprocess.run(
-            ["btrfs", "subvolume", "snapshot", "-r",
-             self.__sourcePath, f"{self.__rootFS}/{self.__name}"],
-            capture_output=True, text=True)
+        with metrics.phase("btrfs_snapshot"):
+            res = subprocess.run(
+                ["btrfs", "subvolume", "snapshot", "-r",
+                 self.__sourcePath, f"{self.__rootFS}/{self.__name}"],
+                capture_output=True, text=True)
         if res.returncode != 0:
             raise ChildProcessError(res.stderr)
         logging.info(
@@ -59,15 +56,50 @@ class BTRFSSnap:
         self.snapshotName = self.__name
         self.snapshotRootDevice = self.__rootDevice
         self.subvolPath = f"{self.__rootSubvol}/{self.__name}" if self.__rootSubvol else self.__name
+        self.snapshotPath = f"{self.__rootFS}/{self.__name}"
         # The `with` statement expects the object to be returned
         return self
-    
+
+    # Transaction id the snapshot was taken at. Everything in the snapshot
+    # was written at or before this generation.
+    def generation(self) -> int:
+        with metrics.phase("btrfs_show"):
+            res = subprocess.run(
+                ["btrfs", "subvolume", "show", self.snapshotPath],
+                capture_output=True, text=True)
+        if res.returncode != 0:
+            raise ChildProcessError(res.stderr)
+        for line in res.stdout.splitlines():
+            key, _, value = line.strip().partition(":")
+            if key == "Generation":
+                return int(value.strip())
+        raise ValueError(f"No generation reported for {self.snapshotPath}")
+
+    # Paths (relative to the snapshot root) of files with data written after
+    # `lastGeneration`. Note that BTRFS only reports data extents here, so
+    # deletions, metadata-only changes and empty files are not included.
+    def findNew(self, lastGeneration: int) -> list:
+        with metrics.phase("btrfs_find_new"):
+            res = subprocess.run(
+                ["btrfs", "subvolume", "find-new", self.snapshotPath, str(lastGeneration)],
+                capture_output=True, text=True)
+        if res.returncode != 0:
+            raise ChildProcessError(res.stderr)
+        paths = {}
+        for line in res.stdout.splitlines():
+            # inode N file offset N len N disk start N offset N gen N flags F PATH
+            fields = line.split(" ", 16)
+            if len(fields) == 17 and fields[0] == "inode":
+                paths[fields[16]] = None
+        return list(paths)
+
     def __exit__(self, exc_type, exc_value, traceback):
         logging.debug(
             f"Deleting snapshot {self.__name} for {self.__sourcePath}")
-        res = subprocess.run(
-            ["btrfs", "subvolume", "delete", f"{self.__rootFS}/{self.__name}"],
-            capture_output=True, text=True)
+        with metrics.phase("btrfs_delete"):
+            res = subprocess.run(
+                ["btrfs", "subvolume", "delete", f"{self.__rootFS}/{self.__name}"],
+                capture_output=True, text=True)
         if res.returncode != 0:
             raise ChildProcessError(res.stderr)
         logging.info(
@@ -77,6 +109,8 @@ class BTRFSSnap:
 
 class LVMSnap:
     _volumeNameRegex = re.compile(r'^[a-zA-Z0-9]+$')
+    # A block level copy keeps inode numbers and ctimes of the origin
+    filesCache = "ctime,size,inode"
 
     def __init__(self, volume: str, name: str, cowSize: int = None) -> None:
         self.__cowSize = cowSize
@@ -84,17 +118,31 @@ class LVMSnap:
             raise ValueError('Invalid snapshot name')
         logging.debug(
             f"Checking if creating snapshot {name} for volume {volume} is possible")
-        _args = ['lvcreate', '--name', name, '--snapshot', "--test", volume]
-        if cowSize:
-            _args.append(f"-L{cowSize}G")
-        res = subprocess.run(_args, capture_output=True, text=True)
-        if res.returncode != 0:
-            raise ChildProcessError(res.stderr)
+        device = sysinfo.lookup(lambda idx: idx.blockDevice(volume))
+        if not device.isLVM:
+            raise ValueError(f"{volume} is not an LVM logical volume")
+        snapshotDevice = os.path.join(
+            os.path.sep, "dev", "mapper",
+            f"{device.volumeGroup.replace('-', '--')}-{name}")
+        if util.exists(snapshotDevice):
+            raise FileExistsError(f"Snapshot {name} already exists: {snapshotDevice}")
         logging.info(f"Snapshot {name} for volume {volume} is possible")
         self.__sourceVolume = volume
-        self.__volumeGroup = volume.split('/')[-2]
+        self.__volumeGroup = device.volumeGroup
         self.__snapshotName = name
 
+    # Dry run of creating the snapshot, fails like lvcreate would, e.g. if
+    # the volume group lacks free extents for the COW area
+    def test(self):
+        _args = ['lvcreate', '--test', '--name', self.__snapshotName,
+                 '--snapshot', self.__sourceVolume]
+        if self.__cowSize:
+            _args.append(f"-L{self.__cowSize}G")
+        with metrics.phase("lvcreate_test"):
+            res = subprocess.run(_args, capture_output=True, text=True)
+        if res.returncode != 0:
+            raise ChildProcessError(res.stderr)
+
     def __enter__(self):
         logging.debug(
             f"Creating snapshot {self.__snapshotName} for volume {self.__sourceVolume}")
@@ -102,14 +150,19 @@ class LVMSnap:
                  '--snapshot', self.__sourceVolume]
         if self.__cowSize:
             _args.append(f"-L{self.__cowSize}G")
-        res = subprocess.run(_args, capture_output=True, text=True)
-        if res.returncode != 0:
-            raise ChildProcessError(res.stderr)
+        with metrics.phase("lvcreate"):
+            proc = subprocess.Popen(_args, stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE, text=True)
+            cgroup.attach(proc.pid)
+            _, stderr = proc.communicate()
+        if proc.returncode != 0:
+            raise ChildProcessError(stderr)
         # Force activation of the snapshot so that it can be mounted
-        res = subprocess.run(
-            ['lvchange', '-ay', '-y',
-                f"{self.__volumeGroup}/{self.__snapshotName}"],
-            capture_output=True, text=True)
+        with metrics.phase("lvchange"):
+            res = subprocess.run(
+                ['lvchange', '-ay', '-y',
+                    f"{self.__volumeGroup}/{self.__snapshotName}"],
+                capture_output=True, text=True)
         if res.returncode != 0:
             raise ChildProcessError(res.stderr)
         logging.info(
@@ -125,8 +178,9 @@ class LVMSnap:
     def __exit__(self, exc_type, exc_value, traceback):
         logging.debug(
             f"Deleting snapshot {self.__snapshotName} for volume {self.__sourceVolume}")
-        res = subprocess.run(
-            ['lvremove', '-f', f"{self.__volumeGroup}/{self.__snapshotName}"], capture_output=True, text=True)
+        with metrics.phase("lvremove"):
+            res = subprocess.run(
+                ['lvremove', '-f', f"{self.__volumeGroup}/{self.__snapshotName}"], capture_output=True, text=True)
         if res.returncode != 0:
             raise ChildProcessError(res.stderr)
         logging.info(
@@ -134,54 +188,197 @@ class LVMSnap:
         return True if exc_type is None else False
 
 
+# Snapshots of several volumes taken as close together in time as possible,
+# for applications that spread their data over more than one LV or subvolume
+# (e.g. a database and its WAL). The members are LVMSnap or BTRFSSnap
+# objects, which validate themselves when they are constructed, so nothing
+# is created unless all of them can be. They are created concurrently and
+# deleted together. With `freezePaths` the filesystems mounted there are
+# frozen with fsfreeze until the last snapshot exists, so that none of them
+# can move ahead of the others in between.
+class SnapshotGroup:
+    def __init__(self, members: list, freezePaths: list = None) -> None:
+        if not members:
+            raise ValueError("A snapshot group needs at least one member")
+        if freezePaths and any(isinstance(member, BTRFSSnap) for member in members):
+            # Taking a snapshot commits a transaction, which waits for the thaw
+            raise ValueError("BTRFS cannot snapshot a frozen filesystem")
+        self.members = list(members)
+        self.__freezePaths = list(freezePaths or [])
+        self.__frozen = []
+        self.__created = []
+
+    def __freeze(self):
+        for path in self.__freezePaths:
+            with metrics.phase("fsfreeze"):
+                res = subprocess.run(["fsfreeze", "--freeze", path],
+                                     capture_output=True, text=True)
+            if res.returncode != 0:
+                raise ChildProcessError(res.stderr)
+            self.__frozen.append(path)
+            logging.debug(f"Froze {path}")
+
+    def __thaw(self):
+        while self.__frozen:
+            path = self.__frozen.pop()
+            res = subprocess.run(["fsfreeze", "--unfreeze", path],
+                                 capture_output=True, text=True)
+            if res.returncode != 0:
+                logging.error(f"Failed to thaw {path}: {res.stderr.strip()}")
+            else:
+                logging.debug(f"Thawed {path}")
+
+    def __delete(self) -> list:
+        errors = []
+        while self.__created:
+            member = self.__created.pop()
+            try:
+                member.__exit__(None, None, None)
+            except ChildProcessError as ex:
+                errors.append(ex)
+        return errors
+
+    def __enter__(self):
+        # A member that cannot be created must fail before the others are
+        # created and, above all, before the filesystems are frozen
+        for member in self.members:
+            if isinstance(member, LVMSnap):
+                member.test()
+        errors = []
+        try:
+            self.__freeze()
+            with metrics.phase("group_snapshot"), \
+                    concurrent.futures.ThreadPoolExecutor(len(self.members)) as pool:
+                # Each member runs in a copy of this context, so that phases
+                # are recorded and throttling applies in the worker threads
+                futures = {pool.submit(contextvars.copy_context().run, member.__enter__):
+                           member for member in self.members}
+                for future in concurrent.futures.as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception as ex:
+                        errors.append(ex)
+                    else:
+                        self.__created.append(futures[future])
+        except BaseException:
+            self.__thaw()
+            self.__delete()
+            raise
+        self.__thaw()
+        if errors:
+            self.__delete()
+            raise errors[0]
+        logging.info(f"Snapshot group of {len(self.members)} volumes created")
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        errors = self.__delete()
+        if errors:
+            raise errors[0]
+        logging.info(f"Snapshot group of {len(self.members)} volumes deleted")
+        return True if exc_type is None else False
+
+
 class Mount:
-    def __init__(self, sourcePath, mountOptions: str = None) -> None:
+    # Options that skip replaying the journal/log on mount. This is only safe
+    # for images of a frozen filesystem, like LVM snapshots (lvcreate freezes
+    # the origin), where the journal holds nothing that is not on disk yet.
+    _noRecoveryOptions = {"ext3": "noload", "ext4": "noload", "xfs": "norecovery"}
+
+    # If `mountpoint` is given it is used (and created if necessary) instead
+    # of a fresh temporary directory. Borg's files cache is keyed on the full
+    # path of each file, so backups of the same source have to be taken from
+    # the same mountpoint every time for the cache to be of any use.
+    # `skipRecovery` adds the options above and `readaheadKb` sets the
+    # readahead of the device for as long as it is mounted, which suits the
+    # single sequential scan borg does.
+    def __init__(self, sourcePath, mountOptions: str = None, mountpoint: str = None,
+                 skipRecovery: bool = False, readaheadKb: int = None) -> None:
         if not util.exists(sourcePath):
             raise FileNotFoundError(f"Device {sourcePath} does not exist")
-        res = subprocess.run(
-            ["lsblk", "-f", "-o", "FSTYPE", sourcePath], capture_output=True, text=True)
-        if res.returncode != 0:
-            raise ChildProcessError(res.stderr)
-        self.fstype = res.stdout.splitlines()[-1].strip()
+        self.fstype = sysinfo.probeFsType(sourcePath)
         self.__sourcePath = sourcePath
         self.sourcePath = sourcePath
         self.__mountOptions = mountOptions
+        self.__stableMountpoint = mountpoint
+        self.__skipRecovery = skipRecovery
+        self.__readaheadKb = readaheadKb
+        self.__readaheadPath = None
+        self.__savedReadahead = None
+        if readaheadKb:
+            device = sysinfo.lookup(lambda idx: idx.blockDevice(sourcePath))
+            self.__readaheadPath = device.readaheadPath()
+
+    def __setReadahead(self, value: str):
+        with open(self.__readaheadPath, "w") as f:
+            f.write(value)
+        logging.debug(f"Readahead of {self.__sourcePath} set to {value}KiB")
+
+    def __restoreReadahead(self):
+        if self.__savedReadahead is None:
+            return
+        try:
+            self.__setReadahead(self.__savedReadahead)
+        except OSError:
+            logging.warning(f"Failed to restore readahead of {self.__sourcePath}")
+        self.__savedReadahead = None
+
+    def __cleanup(self):
+        # Stable mountpoints are left in place for the next run
+        if self.__stableMountpoint:
+            return
+        try:
+            self.__mountpoint.cleanup()
+        except:
+            logging.warning(f"Failed to clean up {self.mountpoint}")
 
     def __enter__(self):
-        self.__mountpoint = tempfile.TemporaryDirectory()
-        self.mountpoint = self.__mountpoint.name
-        _mountOpts = "ro"
+        if self.__stableMountpoint:
+            os.makedirs(self.__stableMountpoint, exist_ok=True)
+            if os.path.ismount(self.__stableMountpoint):
+                raise FileExistsError(
+                    f"Something is already mounted at {self.__stableMountpoint}")
+            self.mountpoint = self.__stableMountpoint
+        else:
+            self.__mountpoint = tempfile.TemporaryDirectory()
+            self.mountpoint = self.__mountpoint.name
+        _mountOpts = "ro,noatime"
         if self.fstype == 'xfs':
             _mountOpts += ',nouuid'
+        if self.__skipRecovery and self.fstype in self._noRecoveryOptions:
+            _mountOpts += f",{self._noRecoveryOptions[self.fstype]}"
         if self.__mountOptions:
             _mountOpts += f",{self.__mountOptions}"
         logging.debug(
-            f"Mounting {self.__sourcePath} to {self.__mountpoint.name}")
-        logging.debug(f"mount -o {_mountOpts} {self.__sourcePath} {self.__mountpoint.name}")
-        res = subprocess.run([
-            'mount', "-o", _mountOpts,
-            str(self.__sourcePath), self.__mountpoint.name
-        ], capture_output=True, text=True)
+            f"Mounting {self.__sourcePath} to {self.mountpoint}")
+        logging.debug(f"mount -o {_mountOpts} {self.__sourcePath} {self.mountpoint}")
+        if self.__readaheadPath:
+            with open(self.__readaheadPath, "r") as f:
+                self.__savedReadahead = f.read().strip()
+            self.__setReadahead(str(self.__readaheadKb))
+        with metrics.phase("mount"):
+            res = subprocess.run([
+                'mount', "-o", _mountOpts,
+                str(self.__sourcePath), self.mountpoint
+            ], capture_output=True, text=True)
         if res.returncode != 0:
-            try:
-                self.__mountpoint.cleanup()
-            except:
-                logging.warning(f"Failed to clean up {self.__mountpoint.name}")
+            self.__restoreReadahead()
+            self.__cleanup()
             raise ChildProcessError(res.stderr)
         logging.info(
-            f"Mounted {self.__sourcePath} at {self.__mountpoint.name}")
+            f"Mounted {self.__sourcePath} at {self.mountpoint}")
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        logging.debug(f"Unmounting {self.__mountpoint.name}")
-        res = subprocess.run(
-            ['umount', self.__mountpoint.name], capture_output=True, text=True)
-        try:
-            self.__mountpoint.cleanup()
-        except:
-            logging.warning(f"Failed to clean up {self.__mountpoint.name}")
+        logging.debug(f"Unmounting {self.mountpoint}")
+        with metrics.phase("umount"):
+            res = subprocess.run(
+                ['umount', self.mountpoint], capture_output=True, text=True)
+        self.__restoreReadahead()
+        self.__cleanup()
         if res.returncode != 0:
             raise ChildProcessError(res.stderr)
-        logging.info(f"Unmounted {self.__mountpoint}")
-        logging.info(f"Deleted {self.__mountpoint}")
+        logging.info(f"Unmounted {self.mountpoint}")
+        if not self.__stableMountpoint:
+            logging.info(f"Deleted {self.mountpoint}")
         return True if exc_type is None else False
@@ -0,0 +1,64 @@
+import logging
+
+import collections
+import concurrent.futures
+import os
+
+import util.sysinfo as sysinfo
+
+
+# What a job reading `sources` and writing to `target` keeps busy while it
+# runs: the target directory and the disks on both sides
+def resourceKeys(sources: list, target: str) -> set:
+    keys = {("repo", os.path.abspath(target))}
+    for source in sources:
+        keys |= {("source", disk) for disk in sysinfo.diskNames(source)}
+    keys |= {("target", disk) for disk in sysinfo.diskNames(target)}
+    return keys
+
+
+# Runs `jobFn(job)` for every job in a process pool. A job only starts when
+# none of the source disks, target disks it uses is already busy with as many
+# jobs as allowed, and when no other job writes to the same target directory
+# (each target holds one lock file and borg locks its repo anyway).
+# `sourceOf` and `targetOf` return the paths a job reads from and writes to,
+# `sourcesOf` all paths it reads from if that can be more than one.
+# Returns the list of jobs that failed.
+def runJobs(jobs: list, jobFn, sourceOf, targetOf, workers: int,
+            perSource: int = 1, perTarget: int = 1, sourcesOf=None) -> list:
+    limits = {"source": perSource, "target": perTarget, "repo": 1}
+    resources = {}
+    for job in jobs:
+        keys = resourceKeys(sourcesOf(job) if sourcesOf else [sourceOf(job)], targetOf(job))
+        resources[id(job)] = keys
+        logging.debug(f"Job {sourceOf(job)} uses {sorted(keys)}")
+    busy = collections.Counter()
+    pending = list(jobs)
+    running = {}
+    failed = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        while pending or running:
+            for job in list(pending):
+                if len(running) >= workers:
+                    break
+                keys = resources[id(job)]
+                if any(busy[key] >= limits[key[0]] for key in keys):
+                    continue
+                busy.update(keys)
+                pending.remove(job)
+                logging.info(f"Starting job {sourceOf(job)} -> {targetOf(job)}")
+                running[pool.submit(jobFn, job)] = job
+            done, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                job = running.pop(future)
+                busy.subtract(resources[id(job)])
+                try:
+                    future.result()
+                except Exception:
+                    logging.exception(
+                        f"Job {sourceOf(job)} -> {targetOf(job)} failed:")
+                    failed.append(job)
+                else:
+                    logging.info(f"Job {sourceOf(job)} -> {targetOf(job)} finished")
+    return failed
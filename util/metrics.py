@@ -0,0 +1,160 @@
+import logging
+
+import contextlib
+import contextvars
+import time
+
+import util.state as state
+
+# Metrics of the run in progress. A context variable keeps concurrent runs
+# (threads or tasks) apart without passing the recorder around.
+_current = contextvars.ContextVar("bkmgrMetrics", default=None)
+
+# Borg's `--stats --json` figures exported to Prometheus
+_BORG_STATS = {
+    "original_size": ("bkmgr_archive_original_bytes", "Original size of the last archive"),
+    "compressed_size": ("bkmgr_archive_compressed_bytes", "Compressed size of the last archive"),
+    "deduplicated_size": ("bkmgr_archive_deduplicated_bytes", "Deduplicated size of the last archive"),
+    "nfiles": ("bkmgr_archive_files", "Number of files in the last archive"),
+}
+
+
+def _escapeLabel(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels(labels: dict) -> str:
+    return ",".join(f'{key}="{_escapeLabel(value)}"' for key, value in labels.items())
+
+
+class RunMetrics:
+    def __init__(self, labels: dict) -> None:
+        self.labels = dict(labels)
+        # Seconds spent in each phase, in the order they were first entered
+        self.phases = {}
+        self.stats = {}
+        self.archive = None
+        # Free form facts about the run, like the snapshot backend used
+        self.details = {}
+        self.status = None
+        # Last progress borg reported, a runner.ProgressEvent
+        self.progress = None
+        self.started = time.time()
+        self.finished = None
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - started
+            self.phases[name] = self.phases.get(name, 0.0) + elapsed
+            logging.debug(f"Phase {name} took {elapsed:.3f}s")
+
+    def finish(self, status: str):
+        self.status = status
+        self.finished = time.time()
+
+    def record(self) -> dict:
+        return {
+            "labels": self.labels,
+            "started": self.started,
+            "finished": self.finished,
+            "duration": (self.finished or time.time()) - self.started,
+            "status": self.status,
+            "archive": self.archive,
+            "details": self.details,
+            "phases": self.phases,
+            "stats": self.stats,
+        }
+
+    def textfile(self) -> str:
+        labels = _labels(self.labels)
+        lines = [
+            "# HELP bkmgr_phase_duration_seconds Time spent in each phase of the last run",
+            "# TYPE bkmgr_phase_duration_seconds gauge",
+        ]
+        for name, seconds in self.phases.items():
+            lines.append(
+                f"bkmgr_phase_duration_seconds{{{labels},{_labels({'phase': name})}}} {seconds:.6f}")
+        record = self.record()
+        lines += [
+            "# HELP bkmgr_run_duration_seconds Duration of the last run",
+            "# TYPE bkmgr_run_duration_seconds gauge",
+            f"bkmgr_run_duration_seconds{{{labels}}} {record['duration']:.6f}",
+            "# HELP bkmgr_run_timestamp_seconds Time the last run finished",
+            "# TYPE bkmgr_run_timestamp_seconds gauge",
+            f"bkmgr_run_timestamp_seconds{{{labels}}} {record['finished'] or time.time():.3f}",
+            "# HELP bkmgr_run_success Whether the last run succeeded",
+            "# TYPE bkmgr_run_success gauge",
+            f"bkmgr_run_success{{{labels}}} {1 if self.status == 'success' else 0}",
+        ]
+        for key, (metric, description) in _BORG_STATS.items():
+            if key in self.stats:
+                lines += [f"# HELP {metric} {description}", f"# TYPE {metric} gauge",
+                          f"{metric}{{{labels}}} {self.stats[key]}"]
+        return "\n".join(lines) + "\n"
+
+    # node_exporter's textfile collector picks up `*.prom` files, both are
+    # replaced atomically so a scrape never sees a half written file
+    def write(self, textfilePath: str = None, jsonPath: str = None):
+        if textfilePath:
+            state.atomicWrite(textfilePath, self.textfile())
+            logging.debug(f"Metrics written to {textfilePath}")
+        if jsonPath:
+            state.atomicWriteJSON(jsonPath, self.record())
+            logging.debug(f"Run record written to {jsonPath}")
+
+
+# Starts recording a new run in the current context
+def start(labels: dict) -> RunMetrics:
+    metrics = RunMetrics(labels)
+    _current.set(metrics)
+    return metrics
+
+
+def current() -> RunMetrics:
+    return _current.get()
+
+
+# Metrics of the run going on in `context`, a contextvars.Context another
+# thread may be running in
+def currentIn(context) -> RunMetrics:
+    return context.get(_current)
+
+
+# Times a phase of the current run, does nothing if no run is recorded
+@contextlib.contextmanager
+def phase(name: str):
+    metrics = _current.get()
+    if metrics is None:
+        yield
+        return
+    with metrics.phase(name):
+        yield
+
+
+# Adds facts about the current run to its record
+def annotate(**details):
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.details.update(details)
+
+
+# Keeps the latest progress of the current run, for anyone watching it
+def recordProgress(event):
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.progress = event
+
+
+# Keeps the final figures borg reported with `--stats --json`
+def recordArchive(archive: dict):
+    metrics = _current.get()
+    if metrics is None:
+        return
+    metrics.archive = archive.get("name")
+    metrics.stats.update(archive.get("stats", {}))
+    if "duration" in archive:
+        metrics.stats["duration"] = archive["duration"]
@@ -0,0 +1,191 @@
+import logging
+
+import fnmatch
+import os
+import queue
+import stat
+import threading
+import time
+
+import util.metrics as metrics
+import util.runner as runner
+import util.sysinfo as sysinfo
+
+# First bytes of a CACHEDIR.TAG, see https://bford.info/cachedir/
+CACHEDIR_SIGNATURE = b"Signature: 8a477f597d28d172789f06886806bc55"
+
+
+# What to leave out of a backup: borg patterns (fm: style unless prefixed,
+# only fm: and pp: are understood by the scan itself, all of them by
+# borg), files larger than `maxFileSize` bytes and, with `excludeCaches`,
+# directories tagged with a CACHEDIR.TAG
+class Rules:
+    def __init__(self, patterns=(), maxFileSize: int = None,
+                 excludeCaches: bool = True) -> None:
+        self.patterns = list(patterns)
+        self.maxFileSize = maxFileSize
+        self.excludeCaches = excludeCaches
+        self.__matchers = []
+        for pattern in self.patterns:
+            style, _, body = pattern.partition(":")
+            if not body or len(style) != 2:
+                style, body = "fm", pattern
+            if style in ("fm", "pp"):
+                self.__matchers.append((style, body.strip("/")))
+
+    # Whether the scan can tell that borg will exclude `relPath`
+    def excludes(self, relPath: str) -> bool:
+        for style, body in self.__matchers:
+            if style == "pp":
+                if relPath == body or relPath.startswith(body + "/"):
+                    return True
+            # Like borg, a match on a directory excludes all of it
+            elif fnmatch.fnmatch(relPath, body) or fnmatch.fnmatch(relPath, body + "/*"):
+                return True
+        return False
+
+
+class ScanResult:
+    def __init__(self) -> None:
+        self.files = 0
+        self.bytes = 0
+        self.directories = 0
+        # Lines of the exclude file found by the scan
+        self.excludes = []
+        self.cacheDirs = 0
+        # False if the scan stopped before it saw everything
+        self.complete = True
+        self.expectedFiles = 0
+        self.expectedBytes = 0
+
+
+def _isCacheDir(path: str) -> bool:
+    try:
+        with open(os.path.join(path, "CACHEDIR.TAG"), "rb") as f:
+            return f.read(len(CACHEDIR_SIGNATURE)) == CACHEDIR_SIGNATURE
+    except OSError:
+        return False
+
+
+# Whether `path` is the root of a filesystem of its own, like a mounted LVM
+# snapshot, so that statvfs tells what is below it. On BTRFS statvfs covers
+# the whole pool with all its subvolumes and snapshots, on a bind mount of a
+# subdirectory all of the filesystem.
+def _wholeFilesystem(path: str) -> bool:
+    try:
+        mount = sysinfo.lookup(lambda idx: idx.mountOf(path))
+    except (ValueError, OSError):
+        return False
+    return mount.mountpoint == os.path.realpath(path) and mount.root == "/" \
+        and mount.fstype != "btrfs"
+
+
+# Walks the trees borg is about to archive with `workers` threads running
+# os.scandir, counts what is there and collects the excludes `rules` call
+# for. `roots` are relative to `sourcePath` like in createArchive, each is
+# walked without leaving its filesystem. The walk stops after `timeLimit`
+# seconds, the totals are estimated then: from statvfs if the roots are
+# whole filesystems (as mounted LVM snapshots are), or else extrapolated
+# from the share of directories walked. With a maximum file size the whole
+# tree is walked regardless, else which files are excluded would depend on
+# how far the walk got.
+def scan(sourcePath: str, rules: Rules, roots=None, workers: int = 8,
+         timeLimit: float = 60.0) -> ScanResult:
+    result = ScanResult()
+    pending = queue.Queue()
+    lock = threading.Lock()
+    if rules.maxFileSize is not None:
+        timeLimit = float("inf")
+    deadline = time.monotonic() + timeLimit
+    stop = threading.Event()
+    expired = threading.Event()
+    rootPaths = [os.path.normpath(os.path.join(sourcePath, root)) for root in roots or ["."]]
+    for rootPath in rootPaths:
+        pending.put((rootPath, os.lstat(rootPath).st_dev))
+
+    def walk(path: str, dev: int):
+        files = 0
+        size = 0
+        excludes = []
+        cacheDirs = 0
+        with os.scandir(path) as entries:
+            for entry in entries:
+                relPath = os.path.relpath(entry.path, sourcePath)
+                if rules.excludes(relPath):
+                    continue
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                if stat.S_ISDIR(st.st_mode):
+                    if st.st_dev != dev:
+                        continue
+                    if rules.excludeCaches and _isCacheDir(entry.path):
+                        cacheDirs += 1
+                        continue
+                    pending.put((entry.path, dev))
+                    continue
+                if rules.maxFileSize is not None and stat.S_ISREG(st.st_mode) \
+                        and st.st_size > rules.maxFileSize:
+                    excludes.append(f"pp:{relPath}")
+                    continue
+                files += 1
+                size += st.st_size if stat.S_ISREG(st.st_mode) else 0
+        with lock:
+            result.files += files
+            result.bytes += size
+            result.directories += 1
+            result.excludes += excludes
+            result.cacheDirs += cacheDirs
+
+    def worker():
+        while not stop.is_set():
+            try:
+                path, dev = pending.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            try:
+                if time.monotonic() < deadline:
+                    walk(path, dev)
+                else:
+                    # Put back for the count of what is left
+                    pending.put((path, dev))
+                    expired.set()
+                    stop.set()
+            except OSError as ex:
+                logging.debug(f"Cannot scan {path}: {ex}")
+            finally:
+                pending.task_done()
+
+    with metrics.phase("prescan"):
+        threads = [threading.Thread(target=worker, daemon=True) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        # Until either everything was walked or the time is up
+        while not stop.wait(0.1):
+            with pending.all_tasks_done:
+                if not pending.unfinished_tasks:
+                    stop.set()
+        for thread in threads:
+            thread.join()
+    left = pending.qsize()
+    result.complete = not expired.is_set()
+    result.expectedFiles = result.files
+    result.expectedBytes = result.bytes
+    if not result.complete:
+        if all(_wholeFilesystem(rootPath) for rootPath in rootPaths):
+            # Excluded data is included, but it is the best there is for free
+            stats = [os.statvfs(rootPath) for rootPath in rootPaths]
+            result.expectedBytes = max(result.bytes, sum(
+                (st.f_blocks - st.f_bfree) * st.f_frsize for st in stats))
+            result.expectedFiles = max(result.files, sum(
+                st.f_files - st.f_ffree for st in stats))
+        elif result.directories:
+            factor = (result.directories + left) / result.directories
+            result.expectedBytes = int(result.bytes * factor)
+            result.expectedFiles = int(result.files * factor)
+    logging.info(
+        f"Pre-scan {'walked' if result.complete else 'estimated'} {result.expectedFiles} " +
+        f"files, {runner.formatBytes(result.expectedBytes)} below {sourcePath}, excluding " +
+        f"{len(result.excludes)} large files and {result.cacheDirs} cache directories")
+    return result
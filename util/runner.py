@@ -0,0 +1,226 @@
+import logging
+
+import collections
+import json
+import os
+import subprocess
+import threading
+import time
+
+import util.cgroup as cgroup
+import util.metrics as metrics
+
+# Number of warning/error lines kept for the exception raised on failure.
+# Borg can be very chatty on large trees, so nothing else is buffered.
+_MESSAGE_TAIL = 64
+# Minimal interval between two progress lines written to the log (seconds)
+_PROGRESS_INTERVAL = 10
+# Seconds borg waits for another borg to release a repo before giving up.
+# Backups, prunes and verifications of a repo all wait as long, a backup
+# right after the previous one has to outlast its background compact.
+LOCK_WAIT = 3600
+
+
+def formatBytes(size) -> str:
+    for unit in ("B", "KiB", "MiB", "GiB", "TiB"):
+        if abs(size) < 1024 or unit == "TiB":
+            return f"{size:.1f}{unit}" if unit != "B" else f"{int(size)}B"
+        size /= 1024
+
+
+class ProgressEvent:
+    def __init__(self, data: dict, previous=None) -> None:
+        self.time = data.get("time", time.time())
+        self.bytesProcessed = data.get("original_size", 0)
+        self.compressedBytes = data.get("compressed_size", 0)
+        self.deduplicatedBytes = data.get("deduplicated_size", 0)
+        self.files = data.get("nfiles", 0)
+        self.path = data.get("path", "")
+        # Rates are computed against the previously reported event
+        self.filesPerSecond = 0.0
+        self.bytesPerSecond = 0.0
+        if previous is not None and self.time > previous.time:
+            elapsed = self.time - previous.time
+            self.filesPerSecond = (self.files - previous.files) / elapsed
+            self.bytesPerSecond = (
+                self.bytesProcessed - previous.bytesProcessed) / elapsed
+
+        # Known only if the amount of data to expect is, see estimate()
+        self.percent = None
+        self.eta = None
+
+    # Fills in percent and the seconds left from the bytes expected in total,
+    # at the average rate since `first`, the first event of the run
+    def estimate(self, expectedBytes: int, first):
+        if not expectedBytes:
+            return
+        self.percent = min(100.0, 100.0 * self.bytesProcessed / expectedBytes)
+        if self.time > first.time and self.bytesProcessed > first.bytesProcessed:
+            rate = (self.bytesProcessed - first.bytesProcessed) / (self.time - first.time)
+            self.eta = max(0.0, (expectedBytes - self.bytesProcessed) / rate)
+
+    def __str__(self) -> str:
+        text = (f"{formatBytes(self.bytesProcessed)} processed, "
+                f"{formatBytes(self.deduplicatedBytes)} deduplicated, "
+                f"{self.files} files ({self.filesPerSecond:.1f} files/s, "
+                f"{formatBytes(self.bytesPerSecond)}/s)")
+        if self.percent is not None:
+            text += f" {self.percent:.1f}%"
+        if self.eta is not None:
+            eta = int(self.eta)
+            text += f" ETA {eta // 3600}:{eta // 60 % 60:02d}:{eta % 60:02d}"
+        return f"{text} {self.path}"
+
+
+class BorgResult:
+    def __init__(self, returncode: int, stdout: str, messages, progress,
+                 timedOut: bool = False) -> None:
+        self.returncode = returncode
+        self.stdout = stdout
+        self.messages = list(messages)
+        # Last progress event seen, None if borg did not report any
+        self.progress = progress
+        # Whether borg was stopped for running longer than allowed
+        self.timedOut = timedOut
+
+    def errorText(self) -> str:
+        return os.linesep.join(self.messages)
+
+
+def _feed(stream, lines):
+    try:
+        for line in lines:
+            stream.write(line)
+            stream.write("\n")
+    except BrokenPipeError:
+        logging.debug("Borg closed its standard input early")
+    finally:
+        try:
+            stream.close()
+        except BrokenPipeError:
+            pass
+
+
+def _drain(stream, chunks: list):
+    for chunk in iter(lambda: stream.read(65536), ""):
+        chunks.append(chunk)
+
+
+def _drainLines(stream, onLine):
+    for line in stream:
+        onLine(line.rstrip("\n"))
+
+
+# Runs `borg <command> --log-json [--progress] <args>` and handles its
+# output line by line as it arrives instead of buffering all of it.
+# `input` is an optional iterable of lines fed to borg's standard input,
+# `onEvent` is called with every ProgressEvent as soon as it is parsed and
+# `onPercent` with (current, total) of every progress_percent message and
+# `onMessage` with every log_message, for output like that of `--list`.
+# `onLine` gets every line of stdout (from another thread) instead of it
+# being collected, for listings too large to keep in memory.
+# `env` holds variables set for borg on top of the current environment.
+# After `timeout` seconds borg is terminated, see BorgResult.timedOut.
+# `expectedBytes` is the size of the data borg create is about to read, if
+# known, for progress events with a percentage and ETA.
+def runBorg(command: str, args: list, cwd=None, progress: bool = False,
+            input=None, onEvent=None, env: dict = None, onPercent=None,
+            onLine=None, timeout: float = None, expectedBytes: int = None,
+            onMessage=None) -> BorgResult:
+    _args = ["borg", command, "--log-json"]
+    if progress:
+        _args.append("--progress")
+    _args += [str(arg) for arg in args]
+    logging.debug(" ".join(_args))
+    proc = subprocess.Popen(
+        _args, cwd=cwd, text=True,
+        env=dict(os.environ, **env) if env else None,
+        stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    cgroup.attach(proc.pid)
+    threads = []
+    if input is not None:
+        threads.append(threading.Thread(
+            target=_feed, args=(proc.stdin, input), daemon=True))
+    # stdout only carries `--json` style results, which are small,
+    # but it still has to be drained concurrently to avoid a deadlock
+    stdout = []
+    if onLine is not None:
+        threads.append(threading.Thread(
+            target=_drainLines, args=(proc.stdout, onLine), daemon=True))
+    else:
+        threads.append(threading.Thread(
+            target=_drain, args=(proc.stdout, stdout), daemon=True))
+    for thread in threads:
+        thread.start()
+    timer = None
+    expired = threading.Event()
+    if timeout is not None:
+        def expire():
+            expired.set()
+            proc.terminate()
+        timer = threading.Timer(max(0.0, timeout), expire)
+        timer.daemon = True
+        timer.start()
+    messages = collections.deque(maxlen=_MESSAGE_TAIL)
+    lastEvent = None
+    firstEvent = None
+    lastLogged = None
+    try:
+        for line in proc.stderr:
+            line = line.rstrip("\n")
+            if not line:
+                continue
+            try:
+                msg = json.loads(line)
+            except ValueError:
+                msg = None
+            if not isinstance(msg, dict):
+                # Not everything borg (or python) prints is JSON
+                logging.debug(line)
+                messages.append(line)
+                continue
+            kind = msg.get("type")
+            if kind == "archive_progress":
+                if msg.get("finished"):
+                    continue
+                lastEvent = ProgressEvent(msg, lastLogged)
+                firstEvent = firstEvent or lastEvent
+                lastEvent.estimate(expectedBytes, firstEvent)
+                metrics.recordProgress(lastEvent)
+                if onEvent is not None:
+                    onEvent(lastEvent)
+                if lastLogged is None or \
+                        lastEvent.time - lastLogged.time >= _PROGRESS_INTERVAL:
+                    logging.info(str(lastEvent))
+                    lastLogged = lastEvent
+            elif kind == "log_message":
+                level = getattr(logging, msg.get("levelname", ""), logging.INFO)
+                logging.log(level, msg.get("message", ""))
+                if level >= logging.WARNING:
+                    messages.append(msg.get("message", ""))
+                if onMessage is not None:
+                    onMessage(msg)
+            elif kind in ("progress_message", "progress_percent"):
+                if onPercent is not None and "current" in msg and "total" in msg:
+                    onPercent(msg["current"], msg["total"])
+                if msg.get("message"):
+                    logging.debug(msg["message"])
+            elif kind == "file_status":
+                logging.debug(f"{msg.get('status', '')} {msg.get('path', '')}")
+            else:
+                logging.debug(line)
+    except BaseException:
+        # Do not leave borg running behind our back
+        proc.terminate()
+        raise
+    finally:
+        returncode = proc.wait()
+        if timer is not None:
+            timer.cancel()
+        for thread in threads:
+            thread.join()
+    timedOut = expired.is_set()
+    if timedOut:
+        logging.warning(f"borg {command} stopped after {timeout:.0f}s")
+    return BorgResult(returncode, "".join(stdout), messages, lastEvent, timedOut)
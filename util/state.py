@@ -0,0 +1,165 @@
+import logging
+
+import fcntl
+import json
+import os
+import tempfile
+import time
+
+STATE_FILE = "state.json"
+RUNS_FILE = "runs.jsonl"
+LOCK_FILE = "bkmgr.lock"
+# Used to hold the name of the current repo before state.json existed
+LEGACY_LOCK_FILE = "lock.txt"
+# Repo directories below TARGET are named after the time they were created
+REPO_NAME_FORMAT = r"%Y-%m-%d_%H:%M:%S"
+
+
+# Writes `text` to `path` so that readers see either the old or the new
+# content, never a partially written file
+def atomicWrite(path: str, text: str):
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmpPath = tempfile.mkstemp(prefix=".tmp-", dir=directory)
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmpPath, 0o644)
+        os.replace(tmpPath, path)
+    except BaseException:
+        try:
+            os.unlink(tmpPath)
+        except FileNotFoundError:
+            pass
+        raise
+    dirFd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dirFd)
+    finally:
+        os.close(dirFd)
+
+
+def atomicWriteJSON(path: str, data):
+    atomicWrite(path, json.dumps(data, indent=2, sort_keys=True) + "\n")
+
+
+# Creation time of a repo as a timestamp, None if `repoName` is not the
+# name of a repo created by bkmgr
+def repoTime(repoName: str) -> float:
+    try:
+        return time.mktime(time.strptime(repoName, REPO_NAME_FORMAT))
+    except ValueError:
+        return None
+
+
+# Names of the repos created by bkmgr in TARGET, oldest first
+def repoNames(targetPath: str) -> list:
+    names = [name for name in os.listdir(targetPath)
+             if repoTime(name) is not None
+             and os.path.isdir(os.path.join(targetPath, name))]
+    return sorted(names, key=repoTime)
+
+
+# bkmgr's own bookkeeping stored next to the repos in TARGET: a JSON
+# document with the current repo and per source data, replaced atomically
+# on every save, and an append-only log with one line per run. Used as a
+# context manager it holds an exclusive lock on TARGET for the whole run,
+# so overlapping runs against the same TARGET fail instead of racing. With
+# `wait` it waits for the lock instead, for short updates by other tools.
+class State:
+    def __init__(self, targetPath: str, wait: bool = False) -> None:
+        self.targetPath = targetPath
+        self.__wait = wait
+        self.path = os.path.join(targetPath, STATE_FILE)
+        self.runsPath = os.path.join(targetPath, RUNS_FILE)
+        self.__lockFd = None
+        self.data = self.__load()
+
+    def __load(self) -> dict:
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            logging.debug(f"No state file at {self.path}, starting empty")
+            return {}
+
+    def __enter__(self):
+        lockPath = os.path.join(self.targetPath, LOCK_FILE)
+        self.__lockFd = os.open(lockPath, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(self.__lockFd,
+                        fcntl.LOCK_EX if self.__wait else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(self.__lockFd)
+            self.__lockFd = None
+            raise BlockingIOError(
+                f"Another bkmgr run holds the lock on {self.targetPath}")
+        logging.debug(f"Locked {lockPath}")
+        # Whatever the previous holder wrote is current now
+        self.data = self.__load()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        fcntl.flock(self.__lockFd, fcntl.LOCK_UN)
+        os.close(self.__lockFd)
+        self.__lockFd = None
+        return True if exc_type is None else False
+
+    # Directory name (below TARGET) of the repo new archives go to. Taken
+    # over from the lock.txt of older versions if there is no state yet.
+    @property
+    def currentRepo(self) -> str:
+        if "currentRepo" not in self.data:
+            legacyPath = os.path.join(self.targetPath, LEGACY_LOCK_FILE)
+            try:
+                with open(legacyPath, "r") as f:
+                    self.data["currentRepo"] = f.read().strip() or None
+                logging.info(f"Current repo taken over from {legacyPath}")
+            except FileNotFoundError:
+                return None
+        return self.data["currentRepo"]
+
+    @currentRepo.setter
+    def currentRepo(self, repoName: str):
+        self.data["currentRepo"] = repoName
+
+    # Per source dictionary, keyed by the absolute path of the source
+    def source(self, sourcePath: str) -> dict:
+        return self.data.setdefault("sources", {}).setdefault(
+            os.path.abspath(sourcePath), {})
+
+    def save(self):
+        atomicWriteJSON(self.path, self.data)
+        logging.debug(f"State saved to {self.path}")
+
+    # Appends a run to the log. A crash can at worst leave a truncated last
+    # line behind, which runs() skips.
+    def recordRun(self, record: dict):
+        line = json.dumps(record, sort_keys=True) + "\n"
+        fd = os.open(self.runsPath, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode())
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    # Logged runs, oldest first, optionally only those of a source or repo
+    def runs(self, sourcePath: str = None, repoName: str = None) -> list:
+        result = []
+        try:
+            with open(self.runsPath, "r") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        logging.warning(f"Skipping damaged line in {self.runsPath}")
+                        continue
+                    if sourcePath and record.get("source") != os.path.abspath(sourcePath):
+                        continue
+                    if repoName and record.get("repo") != repoName:
+                        continue
+                    result.append(record)
+        except FileNotFoundError:
+            pass
+        return result
@@ -0,0 +1,248 @@
+import logging
+
+import ctypes
+import ctypes.util
+import os
+import re
+import stat
+import threading
+
+# In-process replacement for `stat -f`, `findmnt` and `lsblk`. Everything is
+# read from procfs and sysfs and cached, so asking about many sources costs
+# a single scan instead of a few processes per question.
+
+_MOUNTINFO = "/proc/self/mountinfo"
+_SYS_BLOCK = "/sys/class/block"
+_UDEV_DATA = "/run/udev/data"
+
+# Filesystem magic numbers as reported by statfs(2)
+_FS_MAGIC = {
+    0x9123683E: "btrfs",
+    0x58465342: "xfs",
+    0xEF53: "ext4",  # shared by ext2/3/4
+    0x01021994: "tmpfs",
+    0x6969: "nfs",
+    0x65735546: "fuse",
+    0x2FC12FC1: "zfs",
+}
+
+_libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+_octalEscape = re.compile(r"\\([0-7]{3})")
+
+
+def _unescape(field: str) -> str:
+    return _octalEscape.sub(lambda m: chr(int(m.group(1), 8)), field)
+
+
+def _readFile(path: str) -> str:
+    try:
+        with open(path, "r") as f:
+            return f.read().strip()
+    except OSError:
+        return ""
+
+
+# Splits a device mapper name of an LVM volume into VG and LV names.
+# LVM doubles every `-` that is part of a name, e.g. `my--vg-my--lv`.
+def _splitDmName(name: str):
+    parts = re.split(r"(?<!-)-(?!-)", name)
+    if len(parts) != 2:
+        return None, None
+    return parts[0].replace("--", "-"), parts[1].replace("--", "-")
+
+
+# Magic number of the filesystem `path` resides on
+def statfsMagic(path: str) -> int:
+    # f_type is the first member of struct statfs on every architecture,
+    # the buffer is big enough for the rest of the structure
+    buf = ctypes.create_string_buffer(256)
+    if _libc.statfs(os.fsencode(path), buf) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), path)
+    return ctypes.c_ulong.from_buffer(buf).value & 0xFFFFFFFF
+
+
+# Filesystem type stored on a block device, read from its superblock and,
+# failing that, from the udev database. Returns "" if it is unknown.
+def probeFsType(devicePath: str) -> str:
+    try:
+        with open(devicePath, "rb") as f:
+            head = f.read(65536 + 128)
+    except OSError as ex:
+        logging.debug(f"Cannot read superblock of {devicePath}: {ex}")
+        head = b""
+    if head[:4] == b"XFSB":
+        return "xfs"
+    if head[65536 + 64:65536 + 72] == b"_BHRfS_M":
+        return "btrfs"
+    if head[1024 + 56:1024 + 58] == b"\x53\xef":
+        compat = int.from_bytes(head[1024 + 92:1024 + 96], "little")
+        incompat = int.from_bytes(head[1024 + 96:1024 + 100], "little")
+        # extents, 64bit or flex_bg make it ext4, a journal ext3
+        if incompat & (0x40 | 0x80 | 0x200):
+            return "ext4"
+        return "ext3" if compat & 0x4 else "ext2"
+    try:
+        rdev = os.stat(devicePath).st_rdev
+    except OSError:
+        return ""
+    udev = _readFile(os.path.join(
+        _UDEV_DATA, f"b{os.major(rdev)}:{os.minor(rdev)}"))
+    for line in udev.splitlines():
+        if line.startswith("E:ID_FS_TYPE="):
+            return line.split("=", 1)[1]
+    return ""
+
+
+class MountEntry:
+    def __init__(self, line: str) -> None:
+        fields = line.split()
+        separator = fields.index("-")
+        self.mountId = int(fields[0])
+        self.parentId = int(fields[1])
+        self.devNo = fields[2]
+        # For BTRFS this is the mounted subvolume, e.g. `/@home`
+        self.root = _unescape(fields[3])
+        self.mountpoint = _unescape(fields[4])
+        self.options = fields[5].split(",")
+        self.fstype = fields[separator + 1]
+        self.source = _unescape(fields[separator + 2])
+        self.superOptions = fields[separator + 3].split(",") \
+            if len(fields) > separator + 3 else []
+
+
+class BlockDevice:
+    def __init__(self, name: str) -> None:
+        sysPath = os.path.realpath(os.path.join(_SYS_BLOCK, name))
+        self.name = name
+        self.sysPath = sysPath
+        self.devNo = _readFile(os.path.join(sysPath, "dev"))
+        self.isPartition = os.path.exists(os.path.join(sysPath, "partition"))
+        self.parent = os.path.basename(os.path.dirname(sysPath)) \
+            if self.isPartition else None
+        slaves = os.path.join(sysPath, "slaves")
+        self.slaves = sorted(os.listdir(slaves)) if os.path.isdir(slaves) else []
+        self.dmName = _readFile(os.path.join(sysPath, "dm", "name")) or None
+        dmUuid = _readFile(os.path.join(sysPath, "dm", "uuid"))
+        # LVM volumes carry an `LVM-` uuid prefix, snapshot COW devices and
+        # other internals additionally a suffix like `-cow`
+        self.isLVM = dmUuid.startswith("LVM-") and "-" not in dmUuid[4:]
+        self.volumeGroup, self.logicalVolume = _splitDmName(self.dmName) \
+            if self.isLVM else (None, None)
+
+    def readaheadPath(self) -> str:
+        return os.path.join(self.sysPath, "queue", "read_ahead_kb")
+
+
+class Index:
+    def __init__(self) -> None:
+        with open(_MOUNTINFO, "r") as f:
+            self.mounts = [MountEntry(line) for line in f if line.strip()]
+        self.blockDevices = {}
+        self.byDevNo = {}
+        for name in os.listdir(_SYS_BLOCK):
+            device = BlockDevice(name)
+            self.blockDevices[name] = device
+            self.byDevNo[device.devNo] = device
+        logging.debug(
+            f"Indexed {len(self.mounts)} mounts and {len(self.blockDevices)} block devices")
+
+    # The mount `path` resides on. Later entries shadow earlier ones
+    # mounted at the same place, just like the kernel does.
+    def mountOf(self, path: str) -> MountEntry:
+        path = os.path.realpath(path)
+        best = None
+        for entry in self.mounts:
+            mountpoint = entry.mountpoint
+            if path == mountpoint or mountpoint == "/" or \
+                    path.startswith(mountpoint.rstrip("/") + "/"):
+                if best is None or len(mountpoint) >= len(best.mountpoint):
+                    best = entry
+        if best is None:
+            raise ValueError(f"No mount found for {path}")
+        return best
+
+    # Block device a device node (e.g. /dev/vg0/lv) refers to
+    def blockDevice(self, devicePath: str) -> BlockDevice:
+        st = os.stat(devicePath)
+        if not stat.S_ISBLK(st.st_mode):
+            raise ValueError(f"{devicePath} is not a block device")
+        devNo = f"{os.major(st.st_rdev)}:{os.minor(st.st_rdev)}"
+        if devNo not in self.byDevNo:
+            raise ValueError(f"{devicePath} ({devNo}) is not known to sysfs")
+        return self.byDevNo[devNo]
+
+    # Mounts of the filesystem on a block device node, there can be several
+    # (e.g. bind mounts or BTRFS subvolumes)
+    def mountsOfDevice(self, devicePath: str) -> list:
+        device = self.blockDevice(devicePath)
+        return [entry for entry in self.mounts if entry.devNo == device.devNo]
+
+    # Names of the whole disks backing `path`. Device mapper devices are
+    # resolved to the disks below them and partitions to their disk. A block
+    # device node stands for the device itself, anything else for the
+    # filesystem it resides on. Unknown devices are named by their number.
+    def diskNames(self, path: str) -> set:
+        st = os.stat(path)
+        if stat.S_ISBLK(st.st_mode):
+            dev = st.st_rdev
+        else:
+            dev = st.st_dev
+            # BTRFS (and other) mounts have anonymous device numbers,
+            # use the device they were mounted from instead
+            if os.major(dev) == 0:
+                source = self.mountOf(path).source
+                if source.startswith("/") and os.path.exists(source):
+                    dev = os.stat(source).st_rdev
+        devNo = f"{os.major(dev)}:{os.minor(dev)}"
+        if devNo not in self.byDevNo:
+            return {devNo}
+        return self.__disks(self.byDevNo[devNo])
+
+    def __disks(self, device: BlockDevice) -> set:
+        if device.slaves:
+            disks = set()
+            for slave in device.slaves:
+                if slave in self.blockDevices:
+                    disks |= self.__disks(self.blockDevices[slave])
+                else:
+                    disks.add(slave)
+            return disks
+        if device.isPartition:
+            return {device.parent}
+        return {device.name}
+
+
+_index = None
+_indexLock = threading.Lock()
+
+
+# The cached index, built on first use
+def index(refresh: bool = False) -> Index:
+    global _index
+    with _indexLock:
+        if _index is None or refresh:
+            _index = Index()
+        return _index
+
+
+# Calls `query` with the cached index, and once more with a fresh one if
+# that fails. Things created after the index was built are found that way.
+def lookup(query):
+    try:
+        return query(index())
+    except (ValueError, OSError):
+        return query(index(refresh=True))
+
+
+# Filesystem type of the filesystem `path` resides on
+def fsType(path: str) -> str:
+    magic = statfsMagic(path)
+    name = _FS_MAGIC.get(magic)
+    if name and magic != 0xEF53:
+        return name
+    return lookup(lambda idx: idx.mountOf(path)).fstype
+
+
+def diskNames(path: str) -> set:
+    return lookup(lambda idx: idx.diskNames(path))
@@ -0,0 +1,157 @@
+import logging
+
+import concurrent.futures
+import lzma
+import os
+import random
+import stat
+import statistics
+import time
+import zlib
+
+import util.metrics as metrics
+
+# Compression specs (in borg's syntax) benchmarked by default
+CANDIDATES = ("lz4", "zstd,3", "zstd,10", "auto,zstd,3", "zlib,6")
+# Borg's default and the two alternatives picked from
+DEFAULT_CHUNKER = "buzhash,19,23,21,4095"
+# 4 MiB average chunks, fewer chunks to track for large incompressible media
+LARGE_CHUNKER = "buzhash,19,23,22,4095"
+# 256 KiB average chunks, better deduplication of large files changed in place
+SMALL_CHUNKER = "buzhash,14,23,18,4095"
+# Bytes read from every sampled file and from all of them together
+_PER_FILE = 4 * 1024 ** 2
+_TOTAL = 256 * 1024 ** 2
+_LARGE_FILE = 64 * 1024 ** 2
+
+
+# A function compressing bytes like borg would with `spec`, or None if it is
+# not available. Borg's own compressors are used if borg is importable,
+# otherwise only the ones in the standard library are.
+def compressor(spec: str):
+    try:
+        from borg.compress import CompressionSpec
+    except ImportError:
+        name, _, level = spec.partition(",")
+        if name == "zlib":
+            return lambda data: zlib.compress(data, int(level or 6))
+        if name == "lzma":
+            return lambda data: lzma.compress(data, preset=int(level or 6))
+        if name == "none":
+            return lambda data: data
+        return None
+    instance = CompressionSpec(spec).compressor
+    return instance.compress
+
+
+def _sameDevice(path: str, dev: int) -> bool:
+    try:
+        return os.lstat(path).st_dev == dev
+    except OSError:
+        return False
+
+
+# Picks a random `fraction` of the regular files below `root` without leaving
+# its filesystem, and from those a random subset within the byte budget.
+# Returns the sampled (path, size) pairs and the number of files seen.
+def sampleFiles(root: str, fraction: float, seed=None) -> tuple:
+    rng = random.Random(seed)
+    rootDev = os.stat(root).st_dev
+    picked = []
+    seen = 0
+    for dirPath, dirNames, fileNames in os.walk(root):
+        dirNames[:] = [name for name in dirNames
+                       if _sameDevice(os.path.join(dirPath, name), rootDev)]
+        for name in fileNames:
+            path = os.path.join(dirPath, name)
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            seen += 1
+            if rng.random() < fraction:
+                picked.append((path, st.st_size))
+    # Cut down to the budget only once the whole tree was seen, so that the
+    # sample does not come from the directories walked first
+    rng.shuffle(picked)
+    samples = []
+    sampled = 0
+    for path, size in picked:
+        if sampled >= _TOTAL:
+            break
+        samples.append((path, size))
+        sampled += min(size, _PER_FILE)
+    return samples, seen
+
+
+# Compresses the sample with `spec` and returns (spec, MiB/s, ratio).
+# Runs in a worker process.
+def benchmark(spec: str, samples: list) -> tuple:
+    compress = compressor(spec)
+    if compress is None:
+        return spec, None, None
+    original = 0
+    compressed = 0
+    elapsed = 0.0
+    for path, size in samples:
+        try:
+            with open(path, "rb") as f:
+                data = f.read(_PER_FILE)
+        except OSError:
+            continue
+        started = time.perf_counter()
+        result = compress(data)
+        elapsed += time.perf_counter() - started
+        original += len(data)
+        compressed += len(result)
+    if not original or not elapsed:
+        return spec, None, None
+    return spec, original / elapsed / 1024 ** 2, compressed / original
+
+
+# Chooses chunker parameters from the sizes of the sampled files and how
+# well the best candidate compressed them
+def chooseChunker(samples: list, bestRatio: float) -> str:
+    sizes = [size for _, size in samples]
+    if not sizes:
+        return DEFAULT_CHUNKER
+    largeBytes = sum(size for size in sizes if size >= _LARGE_FILE)
+    if statistics.median(sizes) < _LARGE_FILE and largeBytes * 2 < sum(sizes):
+        return DEFAULT_CHUNKER
+    # Mostly large files: media barely compresses and hardly ever changes,
+    # images of disks and databases do and are rewritten in small pieces
+    return LARGE_CHUNKER if bestRatio > 0.95 else SMALL_CHUNKER
+
+
+# Benchmarks `candidates` on a sample of the files below `root` in a process
+# pool and returns (compression, chunkerParams). The best compressing
+# candidate that still reaches `minThroughput` MiB/s wins, the fastest one
+# if none does. Raises ValueError if not all candidates can be benchmarked.
+def tune(root: str, fraction: float = 0.01, minThroughput: float = 100.0,
+         candidates=CANDIDATES, workers: int = None) -> tuple:
+    with metrics.phase("tune_sample"):
+        samples, seen = sampleFiles(root, fraction)
+    logging.info(f"Sampled {len(samples)} of {seen} files below {root}")
+    if not samples:
+        raise ValueError(f"No files to sample below {root}")
+    with metrics.phase("tune_benchmark"):
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(
+                benchmark, candidates, [samples] * len(candidates)))
+    # Without borg's compressors only zlib and lzma are left, and picking the
+    # fastest of those would be worse than borg's default lz4
+    missing = [result[0] for result in results if result[1] is None]
+    if missing:
+        raise ValueError(f"Cannot benchmark {', '.join(missing)}")
+    for spec, throughput, ratio in results:
+        logging.info(f"{spec}: {throughput:.1f}MiB/s, ratio {ratio:.3f}")
+    fastEnough = [result for result in results if result[1] >= minThroughput]
+    if fastEnough:
+        best = min(fastEnough, key=lambda result: (result[2], -result[1]))
+    else:
+        best = max(results, key=lambda result: result[1])
+    chunkerParams = chooseChunker(samples, min(result[2] for result in results))
+    logging.warning(f"Tuned {root}: compression {best[0]}, chunker {chunkerParams}")
+    return best[0], chunkerParams